@@ -1,7 +1,50 @@
 import libtcodpy as libtcod
 import math
+import mmap
 import textwrap
 import shelve
+import threading
+import Queue
+import argparse
+import binascii
+import bisect
+import collections
+import csv
+import glob
+import itertools
+import multiprocessing
+import operator
+import os
+import re
+import select
+import struct
+import sys
+import time
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+ 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None  #only zlib compression then
+
+try:  #only needed to play in a terminal, which is a POSIX thing
+    import termios
+    import tty
+except ImportError:
+    termios = None
+
+try:  #only used to report the peak memory of a bot run, and not on Windows
+    import resource
+except ImportError:
+    resource = None
 
 """0.24.2 changes: Added room size scaling in with a multiplier to MAX_ROOMS upon dungeon level up/down. I have found that I also need to scale the map size to make the scaling make sense. 
 However, due to certain minimums, the early levels will be larger than needed, with long hallways. I'm not sure how I feel about it all. We'll see once more play testing has occurred.
@@ -15,6 +58,16 @@ CAMERA_WIDTH = 80
 CAMERA_HEIGHT = 43
 MAP_WIDTH = 90
 MAP_HEIGHT = 90
+CHUNK_SHIFT = 5  #the map is kept in chunks of 32x32 tiles, see ChunkedMap
+CHUNK_SIZE = 1 << CHUNK_SHIFT
+CHUNK_MASK = CHUNK_SIZE - 1
+VIEW_WIDTH = 160  #the FOV map and "con" only cover this much of the level around the camera (and a chunk more)
+VIEW_HEIGHT = 128
+STREAMED_SIZE = 1 << 14  #the width and height of an endless cave (see StreamedMap), far more than anyone walks
+STREAM_RADIUS = 4  #the chunks this many chunks from the player's are made, or read back, before they can be seen
+EVICT_RADIUS = 6  #the chunks farther than this from the player's...
+EVICT_TURNS = 100  #...that the player hasn't been near for this many turns are written to disk and dropped
+STAIRS_CHUNKS = 8  #how many chunks from the start of an endless cave the stairs are
  
 #sizes/coordinates for GUI
 BAR_WIDTH = 20
@@ -23,6 +76,7 @@ PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT
 MSG_X = BAR_WIDTH + 2
 MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT = PANEL_HEIGHT - 1
+MSG_HISTORY = 5000  #how many messages are kept for the history screen
 INVENTORY_WIDTH = 50
 LEVEL_SCREEN_WIDTH = 40
 CHARACTER_SCREEN_WIDTH = 40
@@ -34,6 +88,7 @@ MAX_ROOMS = 4
 CAVE_MAX_SIZE = 70
 CAVE_MIN_SIZE = 30
 MAX_CAVES = 4
+FIRST_LEVEL = (MAP_WIDTH, MAP_HEIGHT, MAX_ROOMS)  #what the deeper levels grow from, see level_size
 
 #leveling variables
 LEVEL_UP_BASE = 100
@@ -53,26 +108,401 @@ FOV_ALGO = 0
 FOV_LIGHT_WALLS = True  #light walls or not
 TORCH_RADIUS = 6
  
-LIMIT_FPS = 20  #20 frames-per-second maximum
+LIMIT_FPS = 0  #no frame cap, the screen is only redrawn when an event arrives
+ 
+#frame timings, see FrameTimes
+TIMED_PHASES = ['poll', 'keys', 'monsters', 'fov', 'tiles', 'objects', 'panel', 'flush']
+TIMING_FRAMES = 500  #the timings of the last this many frames are kept
+TIMING_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250]  #the edges of the histogram buckets, in ms
+TIMINGS_FILE = 'timings.csv'  #F4 writes the timings here
+ 
+ 
+#save files
+SAVE_FILE = 'savegame.sav'
+SAVE_JOURNAL = 'savegame.jnl'  #what changed since the save file was written
+LEVEL_FILE = 'level%d.lvl'  #a level kept to come back to, see store_level
+CHUNK_FILE = 'level%d.chunks'  #the chunks an endless cave dropped, see ChunkStore
+AUTOSAVE_TURNS = 50  #the game is saved in the background this often, and on every new level
+INPUT_LOG = 'lastsession.rec'  #every session is recorded here, to be played back with --replay
+REPLAY_PREFIX = 'replay-'  #a replay keeps its saves apart from the real ones, in files named with this in front
+BOT_PREFIX = 'bot-'  #and so does a bot run (see run_bot)
+BENCHMARK_PREFIX = 'benchmark-'  #and --benchmark-saves
+SAVE_MAGIC = 'CCSV'
+SAVE_VERSION = 3
+SAVE_COMPRESSION = 'zlib'  #how save files are compressed: 'none', 'zlib' or 'lzma'
+
+#every kind of object a saved game can hold. saves refer to them by their position in this list,
+#so new kinds must only ever be added at the end
+MONSTER_TEMPLATES = ['orc', 'troll', 'void rat', 'rickety skeleton', 'kobold fighter']
+ITEM_TEMPLATES = ['heal', 'poison', 'lightning', 'fireball', 'confuse', 'short sword', 'small shield',
+    'war hammer', 'champions shield', 'padded leather armor', 'leather skullcap', 'broken dagger',
+    'tarnished golden ring']
+TEMPLATES = ['player', 'stairs', 'upstairs', 'dagger'] + MONSTER_TEMPLATES + ITEM_TEMPLATES
+TEMPLATE_IDS = dict((template, i) for (i, template) in enumerate(TEMPLATES))
  
  
 color_dark_wall = libtcod.Color(5, 5, 5)
 color_light_wall = libtcod.Color(63, 50, 31)
 color_dark_ground = libtcod.Color(0, 0, 0)
 color_light_ground = libtcod.Color(127, 101, 63)
+
+#lighting states of a tile, as far as the player knows it
+LIGHT_UNEXPLORED = 0
+LIGHT_REMEMBERED = 1  #explored, but not in FOV right now
+LIGHT_VISIBLE = 2
+LIGHT_STATES = 3
+
+#terrain types, these are the rows of the palette below
+TERRAIN_GROUND = 0
+TERRAIN_WALL = 1
+
+#background color of a tile for every terrain type (row) and lighting state (column).
+#a new terrain type only needs a new row here, render_all looks colors up by state code
+TILE_PALETTE = [
+    #unexplored      remembered          visible
+    [libtcod.black,  color_dark_ground,  color_light_ground],  #ground
+    [libtcod.black,  color_dark_wall,    color_light_wall],    #wall
+]
+
+#the same palette flattened into one list per channel, indexed by tile_state()
+PALETTE_R = [color.r for row in TILE_PALETTE for color in row]
+PALETTE_G = [color.g for row in TILE_PALETTE for color in row]
+PALETTE_B = [color.b for row in TILE_PALETTE for color in row]
+
+def tile_state(terrain, light):
+    #the state code of a cell, which is its index in the flattened palette
+    return terrain * LIGHT_STATES + light
  
  
 class Tile:
-    #a tile of the map and its properties
-    def __init__(self, blocked, block_sight = None):
-        self.blocked = blocked
- 
-        #all tiles start unexplored
-        self.explored = False
- 
+    #a tile of the map and its properties. there's only one tile for each set of properties, in TILES, shared by
+    #all the places on the map that are like it. so a tile can't be changed, the map puts another one in its place
+    def __init__(self, blocked, block_sight = None, explored = False):
         #by default, if a tile is blocked, it also blocks sight
         if block_sight is None: block_sight = blocked
-        self.block_sight = block_sight
+        self.__dict__.update(blocked=blocked, block_sight=block_sight, explored=explored)
+ 
+    def __setattr__(self, name, value):
+        raise TypeError('tiles are shared, change them with the set_tile and explore of the map')
+ 
+TILES = dict(((blocked, block_sight, explored), Tile(blocked, block_sight, explored))
+    for blocked in (False, True) for block_sight in (False, True) for explored in (False, True))
+SOLID_CHUNK = [TILES[True, True, False]] * (CHUNK_SIZE * CHUNK_SIZE)  #all unexplored solid rock
+ 
+class ChunkedMap:
+    #the tiles of a level. it's indexed like the list of columns it replaced, map[x][y], but the tiles are kept in
+    #chunks of CHUNK_SIZE x CHUNK_SIZE, column by column, and a chunk is only made once something in it isn't
+    #solid rock. until then it's SOLID_CHUNK, which they all share, so a huge level that's mostly rock stays small.
+    #tiles are read with map[x][y] and changed with set_tile and explore, which make the chunk first if need be.
+    #a chunk only holds references to the shared TILES, not tiles of its own.
+    def __init__(self, width, height):
+        (self.width, self.height) = (width, height)
+        chunks_high = (height + CHUNK_MASK) >> CHUNK_SHIFT
+        self.chunks = [[SOLID_CHUNK] * chunks_high for i in range((width + CHUNK_MASK) >> CHUNK_SHIFT)]
+        self.columns = [MapColumn(self.chunks[x >> CHUNK_SHIFT], (x & CHUNK_MASK) << CHUNK_SHIFT, height)
+            for x in range(width)]
+        self.shared = set()  #the ids of the chunks the last snapshot holds, see snapshot
+        self.explored_cells = []  #the tiles explored since the last save, as x * height + y
+ 
+    def __len__(self):
+        return self.width
+ 
+    def __getitem__(self, x):
+        return self.columns[x]
+ 
+    def __iter__(self):
+        return iter(self.columns)
+ 
+    def writable(self, x, y):
+        #the chunk the tile at x, y is in and where in it, making the chunk if it's still the shared solid one
+        column = self.chunks[x >> CHUNK_SHIFT]
+        chunk = column[y >> CHUNK_SHIFT]
+        if chunk is SOLID_CHUNK or id(chunk) in self.shared:
+            self.shared.discard(id(chunk))
+            chunk = column[y >> CHUNK_SHIFT] = list(chunk)
+        return (chunk, ((x & CHUNK_MASK) << CHUNK_SHIFT) + (y & CHUNK_MASK))
+ 
+    def set_tile(self, x, y, blocked, block_sight=None):
+        if block_sight is None: block_sight = blocked
+        if blocked and block_sight and self.chunks[x >> CHUNK_SHIFT][y >> CHUNK_SHIFT] is SOLID_CHUNK:
+            return  #it's solid rock already
+        (chunk, i) = self.writable(x, y)
+        chunk[i] = TILES[bool(blocked), bool(block_sight), chunk[i].explored]
+ 
+    def explore(self, x, y):
+        (chunk, i) = self.writable(x, y)
+        tile = chunk[i]
+        chunk[i] = TILES[tile.blocked, tile.block_sight, True]
+        self.explored_cells.append(x * self.height + y)
+ 
+    def snapshot(self):
+        #the chunks as they are now, for save_writer to pack while the game goes on. they're shared rather than
+        #copied, a chunk is only copied when it's next changed (see writable), so the snapshot stays as it was
+        chunks = [list(column) for column in self.chunks]
+        self.shared = set(id(chunk) for column in chunks for chunk in column if chunk is not SOLID_CHUNK)
+        return chunks
+ 
+    def made_tiles(self, x1, y1, x2, y2):
+        #the tiles in a rectangle that are in chunks that were made, as (x, y, tile). the others are all solid rock
+        for cx in range(x1 >> CHUNK_SHIFT, ((x2 - 1) >> CHUNK_SHIFT) + 1):
+            for cy in range(y1 >> CHUNK_SHIFT, ((y2 - 1) >> CHUNK_SHIFT) + 1):
+                chunk = self.chunks[cx][cy]
+                if chunk is SOLID_CHUNK:
+                    continue
+                for x in range(max(cx << CHUNK_SHIFT, x1), min((cx + 1) << CHUNK_SHIFT, x2)):
+                    offset = (x & CHUNK_MASK) << CHUNK_SHIFT
+                    for y in range(max(cy << CHUNK_SHIFT, y1), min((cy + 1) << CHUNK_SHIFT, y2)):
+                        yield (x, y, chunk[offset + (y & CHUNK_MASK)])
+ 
+    def made_chunks(self):
+        #how many chunks were made, out of how many there are
+        return (sum(chunk is not SOLID_CHUNK for column in self.chunks for chunk in column),
+            len(self.chunks) * len(self.chunks[0]))
+ 
+class MapColumn:
+    #one column of a ChunkedMap, map[x]. indexing it with y gives the tile
+    def __init__(self, chunks, offset, height):
+        self.chunks = chunks  #the map's chunks along this column, the same list the map changes
+        self.offset = offset  #where the column starts in each of them
+        self.height = height
+ 
+    def __getitem__(self, y):
+        return self.chunks[y >> CHUNK_SHIFT][self.offset + (y & CHUNK_MASK)]
+ 
+    def __len__(self):
+        return self.height
+ 
+    def __iter__(self):
+        return itertools.islice(itertools.chain.from_iterable(chunk[self.offset:self.offset + CHUNK_SIZE]
+            for chunk in self.chunks), self.height)
+ 
+def chunked_map(columns):
+    #a ChunkedMap like a list of columns of tiles, as the map of a game saved in a shelve was
+    map = ChunkedMap(len(columns), len(columns[0]))
+    for (x, column) in enumerate(columns):
+        for (y, tile) in enumerate(column):
+            map.set_tile(x, y, tile.blocked, tile.block_sight)
+            if tile.explored:
+                map.explore(x, y)
+    return map
+ 
+class StreamedMap(ChunkedMap):
+    #the map of an endless cave. a chunk is carved and given its monsters and items when the player first comes
+    #within STREAM_RADIUS chunks of it, from a seed of its own, so it comes out the same whenever that is. the
+    #chunks the player left far behind go to a ChunkStore with the objects on them and are dropped from memory,
+    #to be read back if the player returns. so the level takes about the same memory however far they walk.
+    def __init__(self, width, height, seed, store):
+        ChunkedMap.__init__(self, width, height)
+        self.seed = seed
+        self.store = store
+        self.resident = {}  #the chunks in memory, with the turn the player was last near them
+        self.dirty = set()  #the resident chunks that differ from their copy in the store, or have none yet
+        self.center = None  #the chunk the player was in the last time stream looked
+ 
+    def set_tile(self, x, y, blocked, block_sight=None):
+        ChunkedMap.set_tile(self, x, y, blocked, block_sight)
+        self.dirty.add((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT))
+ 
+    def explore(self, x, y):
+        ChunkedMap.explore(self, x, y)
+        self.dirty.add((x >> CHUNK_SHIFT, y >> CHUNK_SHIFT))
+ 
+    def stream(self, x, y):
+        #make sure the chunks around x, y are in memory, and drop the ones far away that the player hasn't been
+        #near for a while. this is only done when x, y is in another chunk than last time.
+        #returns the chunks that were made or read back, and the ones that were dropped
+        center = (x >> CHUNK_SHIFT, y >> CHUNK_SHIFT)
+        if center == self.center:
+            return ([], [])
+        self.center = center
+        (cx, cy) = center
+ 
+        arrived = []
+        for chunk_x in range(max(cx - STREAM_RADIUS, 0), min(cx + STREAM_RADIUS + 1, len(self.chunks))):
+            for chunk_y in range(max(cy - STREAM_RADIUS, 0), min(cy + STREAM_RADIUS + 1, len(self.chunks[0]))):
+                chunk = (chunk_x, chunk_y)
+                if chunk not in self.resident:
+                    if chunk in self.store.index:
+                        self.read_back(chunk)
+                    else:
+                        self.generate(chunk)
+                    arrived.append(chunk)
+                self.resident[chunk] = game_turn
+ 
+        gone = [chunk for (chunk, turn) in self.resident.items()
+            if max(abs(chunk[0] - cx), abs(chunk[1] - cy)) > EVICT_RADIUS and game_turn - turn >= EVICT_TURNS]
+        if gone:
+            self.evict(gone)
+        return (arrived, gone)
+ 
+    def generate(self, chunk):
+        #carve a chunk like a cave of make_cave_map, and place monsters and items in it. a passage goes from its
+        #middle to a point on each of its sides, where the passage of the chunk on the other side comes out too,
+        #so every chunk can be reached from every other one
+        global rng
+        (cx, cy) = chunk
+        room = Rect(cx << CHUNK_SHIFT, cy << CHUNK_SHIFT, CHUNK_SIZE, CHUNK_SIZE)
+        (middle_x, middle_y) = room.center()
+        (left, right) = (room.y1 + self.side(cx, cy, 0), room.y1 + self.side(cx + 1, cy, 0))
+        (top, bottom) = (room.x1 + self.side(cx, cy, 1), room.x1 + self.side(cx, cy + 1, 1))
+ 
+        #everything random in it comes from its own generator
+        level_rng = rng
+        rng = libtcod.random_new_from_seed(self.chunk_seed(cx, cy, 2))
+        try:
+            carve_cave(room)
+            create_h_tunnel(room.x1, middle_x, left)
+            create_v_tunnel(left, middle_y, middle_x)
+            create_h_tunnel(middle_x, room.x2 - 1, right)
+            create_v_tunnel(right, middle_y, middle_x)
+            create_v_tunnel(room.y1, middle_y, top)
+            create_h_tunnel(top, middle_x, middle_y)
+            create_v_tunnel(middle_y, room.y2 - 1, bottom)
+            create_h_tunnel(bottom, middle_x, middle_y)
+            place_objects(room)
+        finally:
+            libtcod.random_delete(rng)
+            rng = level_rng
+        self.dirty.add(chunk)
+ 
+    def chunk_seed(self, cx, cy, kind):
+        return zlib.crc32(struct.pack('<Iiii', self.seed, cx, cy, kind)) & 0xffffffff
+ 
+    def side(self, cx, cy, kind):
+        #where the passages cross the left side of a chunk (kind 0) or its top (kind 1)
+        return 2 + self.chunk_seed(cx, cy, kind) % (CHUNK_SIZE - 4)
+ 
+    def pack_chunk(self, chunk, objs):
+        (cx, cy) = chunk
+        flags = tile_flags(self.chunks[cx][cy])
+        return zlib.compress(str(flags) + pack_objects(objs))
+ 
+    def read_tiles(self, chunk):
+        #put a chunk's tiles back from the store. returns the packed objects that were on it
+        (cx, cy) = chunk
+        data = zlib.decompress(self.store.read(chunk))
+        self.chunks[cx][cy] = map_tiles(bytearray(data[:CHUNK_SIZE * CHUNK_SIZE]))
+        return data[CHUNK_SIZE * CHUNK_SIZE:]
+ 
+    def read_back(self, chunk):
+        #bring a chunk back from the store, with the objects that were on it
+        arrived = unpack_objects(self.read_tiles(chunk))
+        for obj in arrived:
+            objects.append(obj)
+        if arrived:
+            self.dirty.add(chunk)  #the copy in the store mustn't bring them back a second time
+ 
+    def evict(self, chunks):
+        #write chunks to the store with the objects on them, and drop both. the player and the stairs stay
+        leaving = dict((chunk, []) for chunk in chunks)
+        for obj in objects:
+            chunk = (obj.x >> CHUNK_SHIFT, obj.y >> CHUNK_SHIFT)
+            if chunk in leaving and obj not in (player, stairs, upstairs):
+                leaving[chunk].append(obj)
+ 
+        objects.remove_all([obj for objs in leaving.values() for obj in objs])
+        records = []
+        for (chunk, objs) in sorted(leaving.items()):
+            records.append((chunk, self.pack_chunk(chunk, objs)))
+            self.chunks[chunk[0]][chunk[1]] = SOLID_CHUNK
+            del self.resident[chunk]
+            self.dirty.discard(chunk)
+        self.store.write(records)
+ 
+    def flush(self):
+        #write the resident chunks that changed to the store, without their objects (the save file has those).
+        #they reach the disk before the save that's handed to save_writer next
+        self.store.write([(chunk, self.pack_chunk(chunk, [])) for chunk in sorted(self.dirty)], sync=True)
+        self.dirty.clear()
+ 
+    def pack_index(self):
+        #what a save file needs to bring the level back after a flush, the store has the chunks: where they are
+        #in it, and which were in memory and for how many turns the player hasn't been near them. the size the
+        #levels above were made at goes along, as the ones made when the player goes up are that size
+        entries = sorted(self.store.index.items())
+        resident = sorted(self.resident.items())
+        return (struct.pack('<IHHHHHHII', self.seed, self.width, self.height, MAP_WIDTH, MAP_HEIGHT,
+                self.center[0], self.center[1], len(entries), len(resident)) +
+            ''.join(struct.pack('<HHII', cx, cy, offset, length) for ((cx, cy), (offset, length)) in entries) +
+            ''.join(struct.pack('<HHI', cx, cy, game_turn - turn) for ((cx, cy), turn) in resident))
+ 
+def unpack_streamed_map(data):
+    #returns the map, and the size the levels above were made at. the objects on the chunks that were in memory
+    #are in the save file, their copies in the store have none. nothing is streamed until the player leaves the
+    #chunk they were in, and by then the objects are all loaded (see finish_loading) for the ones that are dropped
+    (seed, width, height, map_width, map_height, center_x, center_y, count, resident) = struct.unpack_from(
+        '<IHHHHHHII', data)
+    offset = 24
+    index = {}
+    for i in range(count):
+        (cx, cy, chunk_offset, length) = struct.unpack_from('<HHII', data, offset)
+        index[(cx, cy)] = (chunk_offset, length)
+        offset += 12
+ 
+    map = StreamedMap(width, height, seed, ChunkStore(CHUNK_FILE % dungeon_level, index))
+    map.center = (center_x, center_y)
+    for i in range(resident):
+        (cx, cy, age) = struct.unpack_from('<HHI', data, offset)
+        map.read_tiles((cx, cy))
+        map.resident[(cx, cy)] = -age  #the game starts again at turn 0
+        offset += 8
+    return (map, map_width, map_height)
+ 
+class ChunkStore:
+    #the chunks a StreamedMap dropped, one after another in a file. the index has where the latest copy of each is,
+    #as (offset, length). the file only grows while the level lasts, so a save file can keep the index as it was,
+    #and the copies it points to are still there when the game is loaded. the writing is done by save_writer, so
+    #the game doesn't wait on the disk, and until it's done the copies are read from memory
+    def __init__(self, path, index=None):
+        self.path = path
+        if index is None:
+            (index, size) = ({}, 0)  #a new level, the file of an old one is written over from the start
+        else:
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.index = index
+        self.size = size  #the size the file has once everything handed to save_writer is written
+        self.unwritten = {}  #the copies save_writer hasn't written yet
+        self.lock = threading.Lock()
+ 
+    def write(self, records, sync=False):
+        #add (chunk, data) records. with sync, they are on the disk before any save handed to save_writer after them
+        if not records:
+            return
+        offset = self.size
+        with self.lock:
+            for (chunk, data) in records:
+                self.index[chunk] = (self.size, len(data))
+                self.unwritten[chunk] = data
+                self.size += len(data)
+        save_writer.put(('chunks', self, offset, records, sync))
+ 
+    def write_now(self, offset, records, sync):
+        #save_writer's part of write
+        file = open(self.path, 'r+b' if offset else 'wb')
+        file.seek(offset)
+        for (chunk, data) in records:
+            file.write(data)
+        if sync:
+            sync_and_close(file)
+        else:
+            file.close()
+        with self.lock:
+            for (chunk, data) in records:
+                if self.unwritten.get(chunk) is data:
+                    del self.unwritten[chunk]
+ 
+    def read(self, chunk):
+        with self.lock:
+            data = self.unwritten.get(chunk)
+        if data is not None:
+            return data
+        (offset, length) = self.index[chunk]
+        file = open(self.path, 'rb')
+        try:
+            file.seek(offset)
+            return file.read(length)
+        finally:
+            file.close()
  
 class Rect:
     #a rectangle on the map. used to characterize a room.
@@ -92,14 +522,55 @@ class Rect:
         return (self.x1 <= other.x2 and self.x2 >= other.x1 and
                 self.y1 <= other.y2 and self.y2 >= other.y1)
 
+class IdCounter:
+    #hands out the ids of new objects. the next one can be looked at without taking it
+    def __init__(self, next_id=1):
+        self.next_id = next_id
+ 
+    def next(self):
+        id = self.next_id
+        self.next_id += 1
+        return id
+ 
+    def peek(self):
+        return self.next_id
+ 
+object_ids = IdCounter()  #the ids of new objects
+ 
+class ObjectList(list):
+    #the objects of a level, which also keeps a table of them by id
+    def __init__(self, objects=()):
+        list.__init__(self, objects)
+        self.by_id = dict((obj.id, obj) for obj in self)
+ 
+    def append(self, obj):
+        list.append(self, obj)
+        self.by_id[obj.id] = obj
+ 
+    def insert(self, index, obj):
+        list.insert(self, index, obj)
+        self.by_id[obj.id] = obj
+ 
+    def remove(self, obj):
+        list.remove(self, obj)
+        del self.by_id[obj.id]
+ 
+    def remove_all(self, objs):
+        #remove many objects in one pass over the list, rather than one for each
+        for obj in objs:
+            del self.by_id[obj.id]
+        self[:] = [obj for obj in self if obj.id in self.by_id]
+ 
 class Object:
     #this is a generic object: the player, a monster, an item, the stairs...
     #it's always represented by a character on screen.
     def __init__(self, x, y, char, name, color, blocks=False, fighter=None, ai=None, item=None, equipment=None):
+        self.id = object_ids.next()  #stays the same for as long as the object exists, saved games included
         self.x = x
         self.y = y
         self.char = char
         self.name = name
+        self.template = name  #what kind of object it is, see TEMPLATES
         self.color = color
         self.blocks = blocks
         self.fighter = fighter
@@ -156,21 +627,9 @@ class Object:
         objects.remove(self)
         objects.insert(0, self)
  
-    def draw(self):
-        #only show if it's visible to the player
-        if libtcod.map_is_in_fov(fov_map, self.x, self.y):
-            (x, y) = to_camera_coordinates(self.x, self.y)
- 
-            if x is not None:
-                #set the color and then draw the character that represents this object at its position
-                libtcod.console_set_default_foreground(con, self.color)
-                libtcod.console_put_char(con, x, y, self.char, libtcod.BKGND_NONE)
- 
-    def clear(self):
-        #erase the character that represents this object
-        (x, y) = to_camera_coordinates(self.x, self.y)
-        if x is not None:
-            libtcod.console_put_char(con, x, y, ' ', libtcod.BKGND_NONE)
+    def glyph(self):
+        #the character that represents this object and its color, as stored in the frame buffer
+        return (self.char, self.color.r, self.color.g, self.color.b)
  
  
 class Fighter:
@@ -207,9 +666,9 @@ class Fighter:
     def attack(self, target):
         global critical_hit
         #a formula for attack damage
-        hit = (libtcod.random_get_int(0, 1, 20) + self.power) - (libtcod.random_get_int(0, 1, 20) + target.fighter.defense)
-        damage = (libtcod.random_get_int(0, 1, 4) + self.power) - target.fighter.defense
-        critical_hit = libtcod.random_get_int(0, 1, 20)                     
+        hit = (libtcod.random_get_int(rng, 1, 20) + self.power) - (libtcod.random_get_int(rng, 1, 20) + target.fighter.defense)
+        damage = (libtcod.random_get_int(rng, 1, 4) + self.power) - target.fighter.defense
+        critical_hit = libtcod.random_get_int(rng, 1, 20)                     
 
         if hit > 0 and damage > 0:
             if critical_hit > 18:
@@ -258,7 +717,7 @@ class BasicMonster:
     def take_turn(self):
         #a basic monster takes its turn. if you can see it, it can see you
         monster = self.owner
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if in_fov(monster.x, monster.y):
  
             #move towards player if far away
             if monster.distance_to(player) >= 2:
@@ -277,7 +736,7 @@ class ConfusedMonster:
     def take_turn(self):
         if self.num_turns > 0:  #still confused...
             #move in a random direction, and decrease the number of turns confused
-            self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+            self.owner.move(libtcod.random_get_int(rng, -1, 1), libtcod.random_get_int(rng, -1, 1))
             self.num_turns -= 1
  
         else:  #restore the previous AI (this one will be deleted because it's not referenced anymore)
@@ -292,6 +751,7 @@ class Item:
  
     def pick_up(self):
         #add to the player's inventory and remove from the map
+        finish_loading('inventory')
         if len(inventory) >= 26:
             message('Your inventory is full, cannot pick up ' + self.owner.name + '.', libtcod.red)
         else:
@@ -400,74 +860,61 @@ def create_room(room):
     #go through the tiles in the rectangle and make them passable
     for x in range(room.x1 + 1, room.x2):
         for y in range(room.y1 + 1, room.y2):
-            map[x][y].blocked = False
-            map[x][y].block_sight = False
+            map.set_tile(x, y, False)
 
 def carve_cave(room):
     global map
     #go through the tiles in the rectangle and make them passable
     for x in range(room.x1 + 1, room.x2 - 2):
         for y in range(room.y1 + 1, room.y2 - 2):
-            filled_chance = libtcod.random_get_int(0, 0, 100)
+            filled_chance = libtcod.random_get_int(rng, 0, 100)
             if filled_chance < 50:
-                map[x][y].blocked = False
-                map[x][y].block_sight = False
+                map.set_tile(x, y, False)
             else:
-                map[x][y].blocked = True
-                map[x][y].block_sight = True
+                map.set_tile(x, y, True)
 
     for x in range(room.x1 + 1, room.x2 - 2):
         for y in range(room.y1 + 1, room.y2 - 2):
             if map[x][y].blocked is False and map[x-1][y].blocked is True and map[x][y-1].blocked is True or map[x][y].blocked is False and map[x+1][y].blocked is True and map[x][y+1].blocked is True:
-                map[x-1][y].blocked = False
-                map[x][y-1].blocked = False
-                map[x+1][y].blocked = False
-                map[x][y+1].blocked = False
-
-                map[x-1][y].block_sight = False
-                map[x][y-1].block_sight = False
-                map[x+1][y].block_sight = False
-                map[x][y+1].block_sight = False
+                map.set_tile(x-1, y, False)
+                map.set_tile(x, y-1, False)
+                map.set_tile(x+1, y, False)
+                map.set_tile(x, y+1, False)
 
     (start_space_x,start_space_y) = room.center()
-    map[start_space_x][start_space_y].blocked = False
-    map[start_space_x][start_space_y].block_sight = False
+    map.set_tile(start_space_x, start_space_y, False)
 
 def create_h_tunnel(x1, x2, y):
     global map
     #horizontal tunnel. min() and max() are used in case x1>x2
     for x in range(min(x1, x2), max(x1, x2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+        map.set_tile(x, y, False)
  
 def create_v_tunnel(y1, y2, x):
     global map
     #vertical tunnel
     for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+        map.set_tile(x, y, False)
  
 def make_map():
     global map, objects, stairs, dungeon_level, upstairs
  
     #the list of objects with just the player
-    objects = [player]
+    objects = ObjectList([player])
  
-    #fill map with "blocked" tiles
-    map = [[ Tile(True)
-        for y in range(MAP_HEIGHT) ]
-            for x in range(MAP_WIDTH) ]
+    #fill map with "blocked" tiles. no chunk of it is made until something is carved there
+    map = ChunkedMap(MAP_WIDTH, MAP_HEIGHT)
  
     rooms = []
     num_rooms = 0
  
     for r in range(MAX_ROOMS):
         #random width and height
-        w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        w = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         #random position without going out of the boundaries of the map
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = libtcod.random_get_int(rng, 0, MAP_WIDTH - w - 1)
+        y = libtcod.random_get_int(rng, 0, MAP_HEIGHT - h - 1)
  
         #"Rect" class makes rectangles easier to work with
         new_room = Rect(x, y, w, h)
@@ -509,7 +956,7 @@ def make_map():
                 (prev_x, prev_y) = rooms[num_rooms-1].center()
  
                 #draw a coin (random number that is either 0 or 1)
-                if libtcod.random_get_int(0, 0, 1) == 1:
+                if libtcod.random_get_int(rng, 0, 1) == 1:
                     #first move horizontally, then vertically
                     create_h_tunnel(prev_x, new_x, prev_y)
                     create_v_tunnel(prev_y, new_y, new_x)
@@ -526,28 +973,27 @@ def make_map():
     stairs = Object(new_x, new_y, '<', 'stairs', libtcod.white)
     objects.append(stairs)
     stairs.send_to_back()  #so it's drawn below the monsters
+    return num_rooms  #how many of the MAX_ROOMS tries made a room
 
 def make_map_going_up():
     global map, objects, stairs, dungeon_level, upstairs
  
     #the list of objects with just the player
-    objects = [player]
+    objects = ObjectList([player])
  
-    #fill map with "blocked" tiles
-    map = [[ Tile(True)
-        for y in range(MAP_HEIGHT) ]
-            for x in range(MAP_WIDTH) ]
+    #fill map with "blocked" tiles. no chunk of it is made until something is carved there
+    map = ChunkedMap(MAP_WIDTH, MAP_HEIGHT)
  
     rooms = []
     num_rooms = 0
  
     for r in range(MAX_ROOMS):
         #random width and height
-        w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        w = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         #random position without going out of the boundaries of the map
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = libtcod.random_get_int(rng, 0, MAP_WIDTH - w - 1)
+        y = libtcod.random_get_int(rng, 0, MAP_HEIGHT - h - 1)
  
         #"Rect" class makes rectangles easier to work with
         new_room = Rect(x, y, w, h)
@@ -590,7 +1036,7 @@ def make_map_going_up():
                 (prev_x, prev_y) = rooms[num_rooms-1].center()
  
                 #draw a coin (random number that is either 0 or 1)
-                if libtcod.random_get_int(0, 0, 1) == 1:
+                if libtcod.random_get_int(rng, 0, 1) == 1:
                     #first move horizontally, then vertically
                     create_h_tunnel(prev_x, new_x, prev_y)
                     create_v_tunnel(prev_y, new_y, new_x)
@@ -607,17 +1053,16 @@ def make_map_going_up():
     upstairs = Object(new_x, new_y, '<', 'upstairs', libtcod.white)
     objects.append(upstairs)
     upstairs.send_to_back()  #so it's drawn below the monsters
+    return num_rooms  #how many of the MAX_ROOMS tries made a room
 
 def make_initial_map():
-    global map, objects, stairs, dungeon_level
+    global map, objects, stairs, dungeon_level, upstairs
  
     #the list of objects with just the player
-    objects = [player]
+    objects = ObjectList([player])
  
-    #fill map with "blocked" tiles
-    map = [[ Tile(True)
-        for y in range(MAP_HEIGHT) ]
-            for x in range(MAP_WIDTH) ]
+    #fill map with "blocked" tiles. no chunk of it is made until something is carved there
+    map = ChunkedMap(MAP_WIDTH, MAP_HEIGHT)
        
     w = 12
     h = 12
@@ -635,35 +1080,35 @@ def make_initial_map():
  
     player.x = new_x
     player.y = new_y
+    upstairs = None  #there's no going up from here
 
 
     #create down stairs at the center of the last room
     stairs = Object(new_x+1, new_y+1, '<', 'stairs', libtcod.white)
     objects.append(stairs)
     stairs.send_to_back()  #so it's drawn below the monsters
+    return 1  #the one room
 
    
 def make_cave_map():
     global map, objects, stairs, dungeon_level, upstairs
  
     #the list of objects with just the player
-    objects = [player]
+    objects = ObjectList([player])
  
-    #fill map with "blocked" tiles
-    map = [[ Tile(True)
-        for y in range(MAP_HEIGHT) ]
-            for x in range(MAP_WIDTH) ]
+    #fill map with "blocked" tiles. no chunk of it is made until something is carved there
+    map = ChunkedMap(MAP_WIDTH, MAP_HEIGHT)
  
     rooms = []
     num_rooms = 0
  
     for r in range(MAX_CAVES):
         #random width and height
-        w = libtcod.random_get_int(0, CAVE_MIN_SIZE, CAVE_MAX_SIZE)
-        h = libtcod.random_get_int(0, CAVE_MIN_SIZE, CAVE_MAX_SIZE)
+        w = libtcod.random_get_int(rng, CAVE_MIN_SIZE, CAVE_MAX_SIZE)
+        h = libtcod.random_get_int(rng, CAVE_MIN_SIZE, CAVE_MAX_SIZE)
         #random position without going out of the boundaries of the map
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = libtcod.random_get_int(rng, 0, MAP_WIDTH - w - 1)
+        y = libtcod.random_get_int(rng, 0, MAP_HEIGHT - h - 1)
  
         #"Rect" class makes rectangles easier to work with
         new_room = Rect(x, y, w, h)
@@ -706,7 +1151,7 @@ def make_cave_map():
                 (prev_x, prev_y) = rooms[num_rooms-1].center()
  
                 #draw a coin (random number that is either 0 or 1)
-                if libtcod.random_get_int(0, 0, 1) == 1:
+                if libtcod.random_get_int(rng, 0, 1) == 1:
                     #first move horizontally, then vertically
                     create_h_tunnel(prev_x, new_x, prev_y)
                     create_v_tunnel(prev_y, new_y, new_x)
@@ -723,28 +1168,27 @@ def make_cave_map():
     stairs = Object(new_x, new_y, '<', 'stairs', libtcod.white)
     objects.append(stairs)
     stairs.send_to_back()
+    return num_rooms  #how many of the MAX_CAVES tries made a cave
 
 def make_cave_map_going_up():
     global map, objects, stairs, dungeon_level, upstairs
  
     #the list of objects with just the player
-    objects = [player]
+    objects = ObjectList([player])
  
-    #fill map with "blocked" tiles
-    map = [[ Tile(True)
-        for y in range(MAP_HEIGHT) ]
-            for x in range(MAP_WIDTH) ]
+    #fill map with "blocked" tiles. no chunk of it is made until something is carved there
+    map = ChunkedMap(MAP_WIDTH, MAP_HEIGHT)
  
     rooms = []
     num_rooms = 0
  
     for r in range(MAX_CAVES):
         #random width and height
-        w = libtcod.random_get_int(0, CAVE_MIN_SIZE, CAVE_MAX_SIZE)
-        h = libtcod.random_get_int(0, CAVE_MIN_SIZE, CAVE_MAX_SIZE)
+        w = libtcod.random_get_int(rng, CAVE_MIN_SIZE, CAVE_MAX_SIZE)
+        h = libtcod.random_get_int(rng, CAVE_MIN_SIZE, CAVE_MAX_SIZE)
         #random position without going out of the boundaries of the map
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = libtcod.random_get_int(rng, 0, MAP_WIDTH - w - 1)
+        y = libtcod.random_get_int(rng, 0, MAP_HEIGHT - h - 1)
  
         #"Rect" class makes rectangles easier to work with
         new_room = Rect(x, y, w, h)
@@ -787,7 +1231,7 @@ def make_cave_map_going_up():
                 (prev_x, prev_y) = rooms[num_rooms-1].center()
  
                 #draw a coin (random number that is either 0 or 1)
-                if libtcod.random_get_int(0, 0, 1) == 1:
+                if libtcod.random_get_int(rng, 0, 1) == 1:
                     #first move horizontally, then vertically
                     create_h_tunnel(prev_x, new_x, prev_y)
                     create_v_tunnel(prev_y, new_y, new_x)
@@ -807,9 +1251,39 @@ def make_cave_map_going_up():
 
 
 
+def make_endless_cave_map():
+    #make a cave level with no end to it (see StreamedMap). nothing of it is carved yet, the chunks around
+    #the player are once initialize_fov streams them in, and the others as the player gets near
+    global map, objects, stairs, upstairs
+ 
+    #the list of objects with just the player
+    objects = ObjectList([player])
+ 
+    map = StreamedMap(STREAMED_SIZE, STREAMED_SIZE, libtcod.random_get_int(rng, 0, 0x7fffffff),
+        ChunkStore(CHUNK_FILE % dungeon_level))
+ 
+    #the player starts in the middle of the middle chunk, where its passages meet
+    middle = STREAMED_SIZE / 2 + CHUNK_SIZE / 2
+    (player.x, player.y) = (middle, middle)
+    upstairs = None
+    if dungeon_level > 1:
+        upstairs = make_object('upstairs', middle, middle)
+        objects.append(upstairs)
+ 
+    #the stairs down are in the middle of a chunk STAIRS_CHUNKS away, on some side
+    along = libtcod.random_get_int(rng, -STAIRS_CHUNKS, STAIRS_CHUNKS) * CHUNK_SIZE
+    away = STAIRS_CHUNKS * CHUNK_SIZE * (1 if libtcod.random_get_int(rng, 0, 1) else -1)
+    if libtcod.random_get_int(rng, 0, 1):
+        (away, along) = (along, away)
+    stairs = make_object('stairs', middle + away, middle + along)
+    objects.append(stairs)
+    stairs.send_to_back()
+    return 0  #no chunks yet
+ 
+ 
 def random_choice_index(chances):  #choose one option from list of chances, returning its index
     #the dice will land on some number between 1 and the sum of the chances
-    dice = libtcod.random_get_int(0, 1, sum(chances))
+    dice = libtcod.random_get_int(rng, 1, sum(chances))
  
     #go through all chances, keeping the sum so far
     running_sum = 0
@@ -877,138 +1351,175 @@ def place_objects(room):
  
  
     #choose random number of monsters
-    num_monsters = libtcod.random_get_int(0, 0, max_monsters)
+    num_monsters = libtcod.random_get_int(rng, 0, max_monsters)
  
     for i in range(num_monsters):
         #choose random spot for this monster
-        x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-        y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+        x = libtcod.random_get_int(rng, room.x1+1, room.x2-1)
+        y = libtcod.random_get_int(rng, room.y1+1, room.y2-1)
  
         #only place it if the tile is not blocked
         if not is_blocked(x, y):
             choice = random_choice(monster_chances)
-            if choice == 'orc':
-                #create an orc
-                fighter_component = Fighter(hp=25, defense=2, power=4, lore=0, xp=35, death_function=monster_death)
-                ai_component = BasicMonster()
- 
-                monster = Object(x, y, 'o', 'orc', libtcod.darker_green,
-                    blocks=True, fighter=fighter_component, ai=ai_component)
- 
-            elif choice == 'troll':
-                #create a troll
-                fighter_component = Fighter(hp=40, defense=4, power=8, lore=0, xp=100, death_function=monster_death)
-                ai_component = BasicMonster()
- 
-                monster = Object(x, y, 'T', 'troll', libtcod.darker_green,
-                    blocks=True, fighter=fighter_component, ai=ai_component)
-
-            elif choice == 'void rat':
-                #create a void rat
-                fighter_component = Fighter(hp=10, defense=0, power=0, lore=0, xp=15, death_function=monster_death)
-                ai_component = BasicMonster()
- 
-                monster = Object(x, y, 'r', 'void rat', libtcod.dark_chartreuse,
-                    blocks=True, fighter=fighter_component, ai=ai_component)
-            elif choice == 'rickety skeleton':
-                #create a void rat
-                fighter_component = Fighter(hp=14, defense=1, power=1, lore=0, xp=15, death_function=monster_death)
-                ai_component = BasicMonster()
- 
-                monster = Object(x, y, 's', 'rickety skeleton', libtcod.dark_chartreuse,
-                    blocks=True, fighter=fighter_component, ai=ai_component)
-
-            elif choice == 'kobold fighter':
-                #create a void rat
-                fighter_component = Fighter(hp=20, defense=1, power=2, lore=0, xp=20, death_function=monster_death)
-                ai_component = BasicMonster()
- 
-                monster = Object(x, y, 'k', 'kobold fighter', libtcod.dark_chartreuse,
-                    blocks=True, fighter=fighter_component, ai=ai_component)
- 
+            monster = make_monster(choice, x, y)
             objects.append(monster)
  
     #choose random number of items
-    num_items = libtcod.random_get_int(0, 0, max_items)
+    num_items = libtcod.random_get_int(rng, 0, max_items)
  
     for i in range(num_items):
         #choose random spot for this item
-        x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-        y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+        x = libtcod.random_get_int(rng, room.x1+1, room.x2-1)
+        y = libtcod.random_get_int(rng, room.y1+1, room.y2-1)
  
         #only place it if the tile is not blocked
         if not is_blocked(x, y):
             choice = random_choice(item_chances)
-            if choice == 'heal':
-                #create a healing potion
-                item_component = Item(use_function=cast_heal)
-                item = Object(x, y, '!', 'violet potion', libtcod.violet, item=item_component)
-
-            elif choice == 'poison':
-                #create a healing potion
-                item_component = Item(use_function=cast_poison)
-                item = Object(x, y, '!', 'violet potion', libtcod.violet, item=item_component)
- 
-            elif choice == 'lightning':
-                #create a lightning bolt scroll
-                item_component = Item(use_function=cast_lightning)
-                item = Object(x, y, '#', 'scroll of lightning bolt', libtcod.light_yellow, item=item_component)
- 
-            elif choice == 'fireball':
-                #create a fireball scroll
-                item_component = Item(use_function=cast_fireball)
-                item = Object(x, y, '#', 'scroll of fireball', libtcod.light_yellow, item=item_component)
- 
-            elif choice == 'confuse':
-                #create a confuse scroll
-                item_component = Item(use_function=cast_confuse)
-                item = Object(x, y, '#', 'scroll of confusion', libtcod.light_yellow, item=item_component)
-
-            elif choice == 'short sword':
-                #create a sword
-                equipment_component = Equipment(slot='right hand', power_bonus=2, required_level=3)
-                item = Object(x, y, '&', 'short sword', libtcod.sky, equipment=equipment_component)
-
-            elif choice == 'small shield':
-                #create a shield
-                equipment_component = Equipment(slot='left hand', defense_bonus=1, required_level=2)
-                item = Object(x, y, '&', 'small shield', libtcod.orange, equipment=equipment_component)
-
-            elif choice == 'war hammer':
-                #create a sword
-                equipment_component = Equipment(slot='right hand', power_bonus=3, defense_bonus=-1, required_level=5)
-                item = Object(x, y, '&', 'war hammer', libtcod.sky, equipment=equipment_component)
-
-            elif choice == 'champions shield':
-                #create a shield
-                equipment_component = Equipment(slot='left hand', defense_bonus=3, required_level=6)
-                item = Object(x, y, '&', 'champions shield', libtcod.orange, equipment=equipment_component)
-
-            elif choice == 'padded leather armor':
-                #create a shield
-                equipment_component = Equipment(slot='body', defense_bonus=2, required_level=2)
-                item = Object(x, y, '&', 'padded leather armor', libtcod.orange, equipment=equipment_component)
-
-            elif choice == 'leather skullcap':
-                #create a shield
-                equipment_component = Equipment(slot='head', defense_bonus=1, required_level=1)
-                item = Object(x, y, '&', 'leather skullcap', libtcod.orange, equipment=equipment_component)
-
-            elif choice == 'broken dagger':
-                #create a shield
-                equipment_component = Equipment(slot='right hand', required_level=1)
-                item = Object(x, y, '&', 'broken dagger', libtcod.orange, equipment=equipment_component)
-
-            elif choice == 'tarnished golden ring':
-                #create a shield
-                equipment_component = Equipment(slot='right ring finger', lore_bonus=2, required_level=3)
-                item = Object(x, y, '*', 'tarnished golden ring', libtcod.gold, equipment=equipment_component)
- 
+            item = make_item(choice, x, y)
             objects.append(item)
             item.send_to_back()  #items appear below other objects
             item.always_visible = True  #items are visible even out-of-FOV, if in an explored area
  
  
+def make_monster(choice, x, y):
+    #create a monster of the chosen kind
+    if choice == 'orc':
+        #create an orc
+        fighter_component = Fighter(hp=25, defense=2, power=4, lore=0, xp=35, death_function=monster_death)
+        ai_component = BasicMonster()
+
+        monster = Object(x, y, 'o', 'orc', libtcod.darker_green,
+            blocks=True, fighter=fighter_component, ai=ai_component)
+
+    elif choice == 'troll':
+        #create a troll
+        fighter_component = Fighter(hp=40, defense=4, power=8, lore=0, xp=100, death_function=monster_death)
+        ai_component = BasicMonster()
+
+        monster = Object(x, y, 'T', 'troll', libtcod.darker_green,
+            blocks=True, fighter=fighter_component, ai=ai_component)
+
+    elif choice == 'void rat':
+        #create a void rat
+        fighter_component = Fighter(hp=10, defense=0, power=0, lore=0, xp=15, death_function=monster_death)
+        ai_component = BasicMonster()
+
+        monster = Object(x, y, 'r', 'void rat', libtcod.dark_chartreuse,
+            blocks=True, fighter=fighter_component, ai=ai_component)
+    elif choice == 'rickety skeleton':
+        #create a void rat
+        fighter_component = Fighter(hp=14, defense=1, power=1, lore=0, xp=15, death_function=monster_death)
+        ai_component = BasicMonster()
+
+        monster = Object(x, y, 's', 'rickety skeleton', libtcod.dark_chartreuse,
+            blocks=True, fighter=fighter_component, ai=ai_component)
+
+    elif choice == 'kobold fighter':
+        #create a void rat
+        fighter_component = Fighter(hp=20, defense=1, power=2, lore=0, xp=20, death_function=monster_death)
+        ai_component = BasicMonster()
+
+        monster = Object(x, y, 'k', 'kobold fighter', libtcod.dark_chartreuse,
+            blocks=True, fighter=fighter_component, ai=ai_component)
+
+    else:
+        raise ValueError('no such monster: ' + repr(choice))
+ 
+    return monster
+ 
+def make_item(choice, x, y):
+    #create an item of the chosen kind
+    if choice == 'heal':
+        #create a healing potion
+        item_component = Item(use_function=cast_heal)
+        item = Object(x, y, '!', 'violet potion', libtcod.violet, item=item_component)
+
+    elif choice == 'poison':
+        #create a healing potion
+        item_component = Item(use_function=cast_poison)
+        item = Object(x, y, '!', 'violet potion', libtcod.violet, item=item_component)
+
+    elif choice == 'lightning':
+        #create a lightning bolt scroll
+        item_component = Item(use_function=cast_lightning)
+        item = Object(x, y, '#', 'scroll of lightning bolt', libtcod.light_yellow, item=item_component)
+
+    elif choice == 'fireball':
+        #create a fireball scroll
+        item_component = Item(use_function=cast_fireball)
+        item = Object(x, y, '#', 'scroll of fireball', libtcod.light_yellow, item=item_component)
+
+    elif choice == 'confuse':
+        #create a confuse scroll
+        item_component = Item(use_function=cast_confuse)
+        item = Object(x, y, '#', 'scroll of confusion', libtcod.light_yellow, item=item_component)
+
+    elif choice == 'short sword':
+        #create a sword
+        equipment_component = Equipment(slot='right hand', power_bonus=2, required_level=3)
+        item = Object(x, y, '&', 'short sword', libtcod.sky, equipment=equipment_component)
+
+    elif choice == 'small shield':
+        #create a shield
+        equipment_component = Equipment(slot='left hand', defense_bonus=1, required_level=2)
+        item = Object(x, y, '&', 'small shield', libtcod.orange, equipment=equipment_component)
+
+    elif choice == 'war hammer':
+        #create a sword
+        equipment_component = Equipment(slot='right hand', power_bonus=3, defense_bonus=-1, required_level=5)
+        item = Object(x, y, '&', 'war hammer', libtcod.sky, equipment=equipment_component)
+
+    elif choice == 'champions shield':
+        #create a shield
+        equipment_component = Equipment(slot='left hand', defense_bonus=3, required_level=6)
+        item = Object(x, y, '&', 'champions shield', libtcod.orange, equipment=equipment_component)
+
+    elif choice == 'padded leather armor':
+        #create a shield
+        equipment_component = Equipment(slot='body', defense_bonus=2, required_level=2)
+        item = Object(x, y, '&', 'padded leather armor', libtcod.orange, equipment=equipment_component)
+
+    elif choice == 'leather skullcap':
+        #create a shield
+        equipment_component = Equipment(slot='head', defense_bonus=1, required_level=1)
+        item = Object(x, y, '&', 'leather skullcap', libtcod.orange, equipment=equipment_component)
+
+    elif choice == 'broken dagger':
+        #create a shield
+        equipment_component = Equipment(slot='right hand', required_level=1)
+        item = Object(x, y, '&', 'broken dagger', libtcod.orange, equipment=equipment_component)
+
+    elif choice == 'tarnished golden ring':
+        #create a shield
+        equipment_component = Equipment(slot='right ring finger', lore_bonus=2, required_level=3)
+        item = Object(x, y, '*', 'tarnished golden ring', libtcod.gold, equipment=equipment_component)
+
+    else:
+        raise ValueError('no such item: ' + repr(choice))
+ 
+    item.template = choice  #several kinds of item share a name, so remember which one this is
+    return item
+ 
+def make_object(template, x, y):
+    #create a new object of the given kind, as the level generators and new_game do
+    if template == 'player':
+        #create object representing the player
+        """This houses the starting player stats"""
+        fighter_component = Fighter(hp=100, defense=0, power=0, lore=0, xp = 0, death_function=player_death)
+        obj = Object(x, y, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component)
+        obj.level = 1
+    elif template == 'stairs' or template == 'upstairs':
+        obj = Object(x, y, '<', template, libtcod.white)
+    elif template == 'dagger':
+        #the player's initial equipment
+        equipment_component = Equipment(slot='right hand', power_bonus=1)
+        obj = Object(x, y, '-', 'dagger', libtcod.sky, equipment=equipment_component)
+    elif template in MONSTER_TEMPLATES:
+        obj = make_monster(template, x, y)
+    else:
+        obj = make_item(template, x, y)
+    return obj
+ 
 def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
     #render a bar (HP, experience, etc). first calculate the width of the bar
     bar_width = int(float(value) / maximum * total_width)
@@ -1027,22 +1538,41 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
     libtcod.console_print_ex(panel, x + total_width / 2, y, libtcod.BKGND_NONE, libtcod.CENTER,
         name + ': ' + str(value) + '/' + str(maximum))
  
+def get_tile_index():
+    #return a dictionary of the objects standing on each tile, rebuilt at most once per turn
+    global tile_index, tile_index_turn
+ 
+    if tile_index_turn != game_turn:
+        tile_index = {}
+        for obj in objects:
+            tile_index.setdefault((obj.x, obj.y), []).append(obj)
+        tile_index_turn = game_turn
+    return tile_index
+ 
 def get_names_under_mouse():
-    global mouse
+    global mouse, hover_state, hover_names
+ 
+    #nothing under the mouse can have changed unless it moved, the camera moved or a turn passed
+    state = (mouse.cx, mouse.cy, camera_x, camera_y, game_turn)
+    if state == hover_state:
+        return hover_names
+    hover_state = state
  
     #return a string with the names of all objects under the mouse
     (x, y) = (mouse.cx, mouse.cy)
     (x, y) = (camera_x + x, camera_y + y)  #from screen to map coordinates
  
     #create a list with the names of all objects at the mouse's coordinates and in FOV
-    names = [obj.name for obj in objects
-        if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+    names = [obj.name for obj in get_tile_index().get((x, y), [])]
+    if names and not in_fov(x, y):
+        names = []
  
     names = ', '.join(names)  #join the names, separated by commas
-    return names.capitalize()
+    hover_names = names.capitalize()
+    return hover_names
  
 def move_camera(target_x, target_y):
-    global camera_x, camera_y, fov_recompute
+    global camera_x, camera_y
  
     #new camera coordinates (top-left corner of the screen relative to the map)
     x = target_x - CAMERA_WIDTH / 2  #coordinates so that the target is at the center of the screen
@@ -1051,11 +1581,11 @@ def move_camera(target_x, target_y):
     #make sure the camera doesn't see outside the map
     if x < 0: x = 0
     if y < 0: y = 0
-    if x > MAP_WIDTH - CAMERA_WIDTH - 1: x = MAP_WIDTH - CAMERA_WIDTH - 1
-    if y > MAP_HEIGHT - CAMERA_HEIGHT - 1: y = MAP_HEIGHT - CAMERA_HEIGHT - 1
- 
-    if x != camera_x or y != camera_y: fov_recompute = True
+    if x > map.width - CAMERA_WIDTH - 1: x = map.width - CAMERA_WIDTH - 1
+    if y > map.height - CAMERA_HEIGHT - 1: y = map.height - CAMERA_HEIGHT - 1
  
+    if (x, y) != (camera_x, camera_y):
+        root_changed(0, 0, CAMERA_WIDTH, CAMERA_HEIGHT)  #everything under the camera scrolls
     (camera_x, camera_y) = (x, y)
  
 def to_camera_coordinates(x, y):
@@ -1067,60 +1597,240 @@ def to_camera_coordinates(x, y):
  
     return (x, y)
  
+def draw_objects():
+    #the object layer of "con" is rebuilt from a persistent frame buffer. the glyphs visible this
+    #frame are compared against the ones drawn last frame, and only when they differ is the
+    #buffer patched and sent to "con" with a couple of fill calls
+    global drawn_glyphs
+ 
+    glyphs = {}
+ 
+    #collect all objects in the list, except the player. we want it to
+    #always appear over all other objects! so it's collected last.
+    for object in objects:
+        if object != player:
+            collect_glyph(object, glyphs)
+    collect_glyph(player, glyphs)
+ 
+    if glyphs == drawn_glyphs:
+        return  #nothing moved or changed, "con" already shows the right thing
+ 
+    #erase the cells that held a glyph last frame, then write this frame's glyphs
+    if drawn_glyphs is None:
+        object_buffer.clear()
+        root_changed(0, 0, CAMERA_WIDTH, CAMERA_HEIGHT)
+    else:
+        for (x, y) in drawn_glyphs:
+            if (x, y) not in glyphs:
+                object_buffer.set_fore(x, y, 0, 0, 0, ' ')
+                root_changed(x, y, 1, 1)
+    for ((x, y), (char, r, g, b)) in glyphs.items():
+        object_buffer.set_fore(x, y, r, g, b, char)
+        root_changed(x, y, 1, 1)
+ 
+    #only the characters and their colors are filled, the backgrounds come from "con"
+    object_buffer.blit(object_con, fill_back=False)
+    drawn_glyphs = glyphs
+ 
+def collect_glyph(object, glyphs):
+    #cull by the camera rectangle first, it's cheap compared to asking the FOV map
+    (x, y) = (object.x - camera_x, object.y - camera_y)
+    if x < 0 or y < 0 or x >= CAMERA_WIDTH or y >= CAMERA_HEIGHT:
+        return
+ 
+    #only show if it's visible to the player
+    if in_fov(object.x, object.y):
+        glyphs[(x, y)] = object.glyph()
+ 
+def in_fov(x, y):
+    #whether the player can see the tile. the FOV map only covers the view, nothing outside it is in sight
+    (x, y) = (x - view_x, y - view_y)
+    return 0 <= x < view_width and 0 <= y < view_height and libtcod.map_is_in_fov(fov_map, x, y)
+ 
+def compute_fov():
+    libtcod.map_compute_fov(fov_map, player.x - view_x, player.y - view_y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+ 
+def view_needed():
+    #the part of the level the view has to cover: what the camera shows and what the player can see
+    return (max(min(camera_x, player.x - TORCH_RADIUS), 0), max(min(camera_y, player.y - TORCH_RADIUS), 0),
+        min(max(camera_x + CAMERA_WIDTH, player.x + TORCH_RADIUS + 1), map.width),
+        min(max(camera_y + CAMERA_HEIGHT, player.y + TORCH_RADIUS + 1), map.height))
+ 
+def stream_around_player():
+    #on an endless level, bring in the chunks around the player and drop the far ones. the FOV map and "con"
+    #are made again if a chunk in the view changed
+    global tile_index_turn, hover_state
+    if not isinstance(map, StreamedMap):
+        return
+    (arrived, gone) = map.stream(player.x, player.y)
+    if arrived or gone:
+        tile_index_turn = None  #the objects have changed
+        hover_state = None
+    for (cx, cy) in arrived:
+        (x, y) = (cx << CHUNK_SHIFT, cy << CHUNK_SHIFT)
+        if x < view_x + view_width and x + CHUNK_SIZE > view_x and y < view_y + view_height and y + CHUNK_SIZE > view_y:
+            place_view()
+            break
+ 
+def place_view():
+    #put the view around what it has to cover, on chunk boundaries, and make the FOV map and "con" for it.
+    #everything is painted again after this. only the chunks in it that were made have to be looked at,
+    #the FOV map starts out as solid rock
+    global view_x, view_y, view_width, view_height, fov_map, con, fov_recompute
+    fov_recompute = True
+    (x1, y1, x2, y2) = view_needed()
+    (old_width, old_height) = (view_width, view_height)
+ 
+    #a chunk more than VIEW_WIDTH and VIEW_HEIGHT, for what putting it on a chunk boundary took off
+    view_x = max(min((x1 + x2 - VIEW_WIDTH) / 2, map.width - VIEW_WIDTH), 0) >> CHUNK_SHIFT << CHUNK_SHIFT
+    view_y = max(min((y1 + y2 - VIEW_HEIGHT) / 2, map.height - VIEW_HEIGHT), 0) >> CHUNK_SHIFT << CHUNK_SHIFT
+    view_width = min(VIEW_WIDTH + CHUNK_SIZE, map.width - view_x)
+    view_height = min(VIEW_HEIGHT + CHUNK_SIZE, map.height - view_y)
+ 
+    if fov_map is not None:
+        libtcod.map_delete(fov_map)
+    fov_map = libtcod.map_new(view_width, view_height)
+    libtcod.map_clear(fov_map)
+    for (x, y, tile) in map.made_tiles(view_x, view_y, view_x + view_width, view_y + view_height):
+        libtcod.map_set_properties(fov_map, x - view_x, y - view_y, not tile.blocked, not tile.block_sight)
+ 
+    #"con" holds the tiles of the view, it's only made again if the view's size changed
+    if headless:
+        return  #there may not even be a root console
+    if con is None or (view_width, view_height) != (old_width, old_height):
+        if con is not None:
+            libtcod.console_delete(con)
+        con = libtcod.console_new(view_width, view_height)
+ 
+def paint_tiles(x1, y1, x2, y2):
+    #paint the backgrounds of the tiles in a rectangle of the view onto "con", according to the FOV
+    codes = []
+    for y in range(y1, y2):
+        for x in range(x1, x2):
+            tile = map[x][y]
+ 
+            #nothing beyond the torch radius can be in FOV, so don't bother asking
+            visible = (abs(x - player.x) <= TORCH_RADIUS and abs(y - player.y) <= TORCH_RADIUS and
+                in_fov(x, y))
+ 
+            if visible:
+                #since it's visible, explore it
+                if not tile.explored:
+                    map.explore(x, y)
+                light = LIGHT_VISIBLE
+            elif tile.explored:
+                #if it's not visible right now, the player can only see it if it's explored
+                light = LIGHT_REMEMBERED
+            else:
+                light = LIGHT_UNEXPLORED
+ 
+            if tile.block_sight:
+                codes.append(tile_state(TERRAIN_WALL, light))
+            else:
+                codes.append(tile_state(TERRAIN_GROUND, light))
+ 
+    #look every background color up in the palette and set them all in one go
+    back_r = [PALETTE_R[code] for code in codes]
+    back_g = [PALETTE_G[code] for code in codes]
+    back_b = [PALETTE_B[code] for code in codes]
+ 
+    (width, height) = (x2 - x1, y2 - y1)
+    if width == view_width and height == view_height:
+        libtcod.console_fill_background(con, back_r, back_g, back_b)
+    else:
+        #only part of the view, it goes through a borrowed console the size of the rectangle
+        window = console_pool.acquire(width, height)
+        libtcod.console_fill_background(window, back_r, back_g, back_b)
+        libtcod.console_blit(window, 0, 0, width, height, con, x1 - view_x, y1 - view_y)
+        console_pool.release(window)
+    root_changed(x1 - camera_x, y1 - camera_y, width, height)
+ 
+def paint_around(positions):
+    #paint the tiles within the torch radius of any of the given positions, as far as the view goes
+    x1 = max(min(x for (x, y) in positions) - TORCH_RADIUS, view_x)
+    y1 = max(min(y for (x, y) in positions) - TORCH_RADIUS, view_y)
+    x2 = min(max(x for (x, y) in positions) + TORCH_RADIUS + 1, view_x + view_width)
+    y2 = min(max(y for (x, y) in positions) + TORCH_RADIUS + 1, view_y + view_height)
+    paint_tiles(x1, y1, x2, y2)
+ 
 def render_all():
-    global fov_map, color_dark_wall, color_light_wall
-    global color_dark_ground, color_light_ground
-    global fov_recompute
+    global fov_map, fov_recompute, fov_position
  
+    frame_times.start()
+    stream_around_player()
     move_camera(player.x, player.y)
  
-    if fov_recompute:
-        #recompute FOV if needed (the player moved or something)
+    #the view only has to move when the camera gets near its edge
+    (x1, y1, x2, y2) = view_needed()
+    if x1 < view_x or y1 < view_y or x2 > view_x + view_width or y2 > view_y + view_height:
+        place_view()
+ 
+    #"con" holds the whole view, so the FOV only has to be computed again when the player moves,
+    #the view moves or the level changes. moving the camera just blits a different part of it.
+    moved = fov_recompute or (player.x, player.y) != fov_position
+    if moved:
+        compute_fov()
+    frame_times.lap('fov')
+    if moved:
+        if headless:
+            explore_around_player()  #nothing is shown, but the monsters still go by what the player sees
+        elif fov_recompute:
+            #a new level or view, every tile has to be painted
+            paint_tiles(view_x, view_y, view_x + view_width, view_y + view_height)
+        else:
+            #only the tiles around where the player was and is now can look any different
+            paint_around([fov_position, (player.x, player.y)])
         fov_recompute = False
-        libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-        libtcod.console_clear(con)
- 
-        #go through all tiles, and set their background color according to the FOV
-        for y in range(CAMERA_HEIGHT):
-            for x in range(CAMERA_WIDTH):
-                (map_x, map_y) = (camera_x + x, camera_y + y)
-                visible = libtcod.map_is_in_fov(fov_map, map_x, map_y)
- 
-                wall = map[map_x][map_y].block_sight
-                if not visible:
-                    #if it's not visible right now, the player can only see it if it's explored
-                    if map[map_x][map_y].explored:
-                        if wall:
-                            libtcod.console_set_char_background(con, x, y, color_dark_wall, libtcod.BKGND_SET)
-                        else:
-                            libtcod.console_set_char_background(con, x, y, color_dark_ground, libtcod.BKGND_SET)
-                else:
-                    #it's visible
-                    if wall:
-                        libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET )
-                    else:
-                        libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET )
-                    #since it's visible, explore it
-                    map[map_x][map_y].explored = True
+    fov_position = (player.x, player.y)
+    if headless:
+        frame_times.lap('tiles')
+        return
  
-    #draw all objects in the list, except the player. we want it to
-    #always appear over all other objects! so it's drawn later.
-    for object in objects:
-        if object != player:
-            object.draw()
-    player.draw()
+    #blit the part of "con" under the camera to the root console
+    libtcod.console_blit(con, camera_x - view_x, camera_y - view_y, CAMERA_WIDTH, CAMERA_HEIGHT, 0, 0, 0)
+    frame_times.lap('tiles')
  
-    #blit the contents of "con" to the root console
-    libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
+    #then the objects on top of it, keeping the backgrounds that are already there
+    draw_objects()
+    libtcod.console_blit(object_con, 0, 0, CAMERA_WIDTH, CAMERA_HEIGHT, 0, 0, 0, 1.0, 0.0)
+    frame_times.lap('objects')
  
+    render_panel()
+ 
+    #blit the contents of "panel" to the root console
+    libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+    frame_times.lap('panel')
+ 
+def explore_around_player():
+    #mark the tiles the player sees as explored, which painting them does when there's a screen
+    for x in range(max(player.x - TORCH_RADIUS, 0), min(player.x + TORCH_RADIUS + 1, map.width)):
+        for y in range(max(player.y - TORCH_RADIUS, 0), min(player.y + TORCH_RADIUS + 1, map.height)):
+            if in_fov(x, y) and not map[x][y].explored:
+                map.explore(x, y)
+ 
+def render_panel():
+    #"panel" keeps its contents between frames, so it's only drawn again when something it shows has changed
+    global panel_state
+ 
+    names = get_names_under_mouse()
+    timings = frame_times.overlay_lines() if show_timings else None
+    state = (msg_version, player.fighter.hp, player.fighter.max_hp, dungeon_level, names, timings)
+    if state == panel_state:
+        return
+    panel_state = state
+    root_changed(0, PANEL_Y, SCREEN_WIDTH, PANEL_HEIGHT)
  
     #prepare to render the GUI panel
     libtcod.console_set_default_background(panel, libtcod.black)
     libtcod.console_clear(panel)
  
-    #print the game messages, one line at a time
+    #print the game messages, one line at a time, or the frame timings in their place when F3 turned them on
+    if timings is not None:
+        lines = [(line, libtcod.light_gray) for line in timings]
+    else:
+        lines = game_msgs.lines(MSG_WIDTH, MSG_HEIGHT)
     y = 1
-    for (line, color) in game_msgs:
+    for (line, color) in lines:
         libtcod.console_set_default_foreground(panel, color)
         libtcod.console_print_ex(panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
         y += 1
@@ -1134,28 +1844,543 @@ def render_all():
  
     #display names of objects under the mouse
     libtcod.console_set_default_foreground(panel, libtcod.light_gray)
-    libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
+    libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, names)
  
-    #blit the contents of "panel" to the root console
-    libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
  
+def root_changed(x=0, y=0, width=SCREEN_WIDTH, height=SCREEN_HEIGHT):
+    #a rectangle of the root console is about to be drawn over, the terminal only reads those cells back
+    if terminal is not None:
+        terminal.touch(x, y, width, height)
  
-def message(new_msg, color = libtcod.white):
-    #split the message if necessary, among multiple lines
-    new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
+def flush_console():
+    #present the root console, in the window or in the terminal. a replay or a bot run doesn't show anything
+    if headless:
+        return
+    if terminal is not None:
+        terminal.present()
+    else:
+        libtcod.console_flush()
+ 
+def wait_for_event(key, mouse):
+    #sleep until a key is pressed or the mouse does something. every event goes into the input log,
+    #and during a replay comes from it instead
+    if input_log.replaying:
+        pass
+    elif terminal is not None:
+        terminal.wait_for_event(key, mouse)
+    else:
+        libtcod.sys_wait_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE, key, mouse, False)
+    input_log.event(key, mouse)
+ 
+def wait_for_keypress():
+    #sleep until a key is pressed, and return it
+    key = libtcod.Key()
+    mouse = libtcod.Mouse()
+    if input_log.replaying:
+        pass
+    elif terminal is None:
+        key = libtcod.console_wait_for_keypress(True)
+    else:
+        while key.vk == libtcod.KEY_NONE:
+            terminal.wait_for_event(key, mouse)
+    input_log.event(key, mouse)
+    return key
+ 
+ 
+#an input log starts with INPUT_LOG_MAGIC, its version and the seed of the session, followed by records that
+#are each a letter for their kind and what it holds: E for an event, T for the end of a turn, F for a file
+#the game loaded (its name, length and contents), since a replay has to start from the same saved game.
+INPUT_LOG_MAGIC = 'CCIR'
+INPUT_LOG_VERSION = 1
+INPUT_LOG_HEADER = struct.Struct('<4sHI')
+INPUT_EVENT = struct.Struct('<BBBhhB')  #key vk, c and flags, mouse cx, cy and flags
+INPUT_TURN = struct.Struct('<Ii')  #the game turn and the player's hp, to notice a replay going its own way
+KEY_FLAGS = ['pressed', 'lalt', 'lctrl', 'ralt', 'rctrl', 'shift']
+MOUSE_FLAGS = ['lbutton', 'rbutton', 'mbutton', 'lbutton_pressed', 'rbutton_pressed', 'mbutton_pressed',
+    'wheel_up', 'wheel_down']
+ 
+class ReplayEnded(Exception):
+    #the input log being played back has nothing more in it
+    pass
+ 
+class InputLog:
+    #records a session: the seed, every key and mouse event the game waited for, the turns and the saved games
+    #it loaded. played back, the same events make the game do exactly the same again, without showing anything.
+    def __init__(self, path, seed=None):
+        self.replaying = seed is None
+        self.events = 0
+        self.turns = 0
+        if self.replaying:
+            self.file = open(path, 'rb')
+            (magic, version, self.seed) = INPUT_LOG_HEADER.unpack(self.file.read(INPUT_LOG_HEADER.size))
+            if (magic, version) != (INPUT_LOG_MAGIC, INPUT_LOG_VERSION):
+                raise ValueError(path + ' is not an input log this version of the game can play back')
+        else:
+            self.seed = seed
+            self.file = open(path, 'wb')
+            self.file.write(INPUT_LOG_HEADER.pack(INPUT_LOG_MAGIC, INPUT_LOG_VERSION, seed))
+ 
+    def close(self):
+        self.file.close()
+ 
+    def read(self, kind, size):
+        #the next record, which has to be of the given kind
+        found = self.file.read(1)
+        if not found:
+            raise ReplayEnded()
+        if found != kind:
+            raise ValueError('the replay went its own way after ' + str(self.turns) + ' turns')
+        return self.file.read(size)
+ 
+    def event(self, key, mouse):
+        #record the event the game just got, or during a replay, fill in the one it got back then
+        self.events += 1
+        if not self.replaying:
+            key_flags = sum(1 << i for (i, name) in enumerate(KEY_FLAGS) if getattr(key, name))
+            mouse_flags = sum(1 << i for (i, name) in enumerate(MOUSE_FLAGS) if getattr(mouse, name))
+            self.file.write('E' + INPUT_EVENT.pack(key.vk, key.c, key_flags, mouse.cx, mouse.cy, mouse_flags))
+            return
  
-    for line in new_msg_lines:
-        #if the buffer is full, remove the first line to make room for the new one
-        if len(game_msgs) == MSG_HEIGHT:
-            del game_msgs[0]
+        (key.vk, key.c, key_flags, mouse.cx, mouse.cy, mouse_flags) = INPUT_EVENT.unpack(self.read('E', INPUT_EVENT.size))
+        for (i, name) in enumerate(KEY_FLAGS):
+            setattr(key, name, key_flags & (1 << i) != 0)
+        for (i, name) in enumerate(MOUSE_FLAGS):
+            setattr(mouse, name, mouse_flags & (1 << i) != 0)
+ 
+    def turn(self):
+        #mark the end of a turn. it's also when the log is written out, so a crash loses at most one turn of it
+        self.turns += 1
+        state = (game_turn, player.fighter.hp)
+        if not self.replaying:
+            self.file.write('T' + INPUT_TURN.pack(*state))
+            self.file.flush()
+        elif INPUT_TURN.unpack(self.read('T', INPUT_TURN.size)) != state:
+            raise ValueError('the replay went its own way after ' + str(self.turns) + ' turns')
+ 
+    def saved_files(self, paths):
+        #record the saved game files that are about to be loaded, or during a replay, put back the recorded ones
+        if not self.replaying:
+            for path in paths:
+                if os.path.exists(path):
+                    file = open(path, 'rb')
+                    data = file.read()
+                    file.close()
+                    self.file.write('F' + pack_string(path) + struct.pack('<I', len(data)) + data)
+            return
  
-        #add the new line as a tuple, with the text and the color
-        game_msgs.append( (line, color) )
+        #a replay has files of its own, named with REPLAY_PREFIX in front of the recorded ones (see use_files_named)
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        while True:
+            kind = self.file.read(1)
+            if kind != 'F':
+                if kind:
+                    self.file.seek(-1, os.SEEK_CUR)
+                break
+            (length,) = struct.unpack('<H', self.file.read(2))
+            path = REPLAY_PREFIX + self.file.read(length)
+            (length,) = struct.unpack('<I', self.file.read(4))
+            file = open(path, 'wb')
+            file.write(self.file.read(length))
+            file.close()
+ 
+class ConsolePool:
+    #off-screen consoles kept around for reuse, keyed by their size. menus borrow one while
+    #they're shown and give it back afterwards, instead of allocating a new native console every time.
+    def __init__(self, max_per_size=2):
+        self.max_per_size = max_per_size
+        self.free = {}
+ 
+    def acquire(self, width, height):
+        #return a blank console of the given size, reusing a released one if there is any
+        consoles = self.free.get((width, height))
+        if consoles:
+            window = consoles.pop()
+        else:
+            window = libtcod.console_new(width, height)
+ 
+        libtcod.console_set_default_background(window, libtcod.black)
+        libtcod.console_set_default_foreground(window, libtcod.white)
+        libtcod.console_clear(window)
+        return window
+ 
+    def release(self, window):
+        #give a console back. if enough of that size are already waiting, it's deleted instead
+        size = (libtcod.console_get_width(window), libtcod.console_get_height(window))
+        consoles = self.free.setdefault(size, [])
+        if len(consoles) < self.max_per_size:
+            consoles.append(window)
+        else:
+            libtcod.console_delete(window)
  
+    def clear(self):
+        #delete every console waiting in the pool
+        for consoles in self.free.values():
+            for window in consoles:
+                libtcod.console_delete(window)
+        self.free = {}
+ 
+ 
+class FrameTimes:
+    #how long each phase of play_game took, in each of the last TIMING_FRAMES frames it ran in. timing a phase
+    #only takes the time after it, the percentiles and histograms are worked out when they are shown or written
+    def __init__(self):
+        self.samples = collections.OrderedDict((phase, collections.deque(maxlen=TIMING_FRAMES))
+            for phase in TIMED_PHASES)
+        self.mark = time.time()
+ 
+    def start(self):
+        #the next phase is timed from now
+        self.mark = time.time()
+ 
+    def lap(self, phase):
+        #the time since start, or since the last lap, went to this phase
+        now = time.time()
+        self.samples[phase].append(now - self.mark)
+        self.mark = now
+ 
+    def last(self, phase):
+        samples = self.samples[phase]
+        return samples[-1] if samples else 0.0
+ 
+    def percentile(self, phase, fraction):
+        samples = sorted(self.samples[phase])
+        if not samples:
+            return 0.0
+        return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+ 
+    def overlay_lines(self):
+        #the lines the panel shows instead of the messages: each phase's time in the last frame and the 95th
+        #percentile, in milliseconds, in two columns
+        cells = ['%-8s %6.2f %6.2f' % (phase, self.last(phase) * 1000, self.percentile(phase, 0.95) * 1000)
+            for phase in self.samples]
+        header = '%-8s %6s %6s' % ('ms', 'now', 'p95')
+        half = (len(cells) + 1) / 2
+        return [header + '   ' + header] + [
+            '   '.join(cells[i::half]) for i in range(half)]
+ 
+    def write_csv(self, path):
+        #a row for each phase: the frames it was timed in, its last, mean, median, 95th percentile and worst time,
+        #then its histogram, the number of frames in which it took up to each of TIMING_BUCKETS ms and longer
+        file = open(path, 'wb')
+        writer = csv.writer(file)
+        writer.writerow(['phase', 'frames', 'last ms', 'mean ms', 'p50 ms', 'p95 ms', 'max ms'] +
+            ['<= %g ms' % edge for edge in TIMING_BUCKETS] + ['> %g ms' % TIMING_BUCKETS[-1]])
+        for (phase, samples) in self.samples.items():
+            times = sorted(sample * 1000 for sample in samples)
+            histogram = [0] * (len(TIMING_BUCKETS) + 1)
+            for ms in times:
+                histogram[bisect.bisect_left(TIMING_BUCKETS, ms)] += 1
+            writer.writerow([phase, len(times)] + ['%.3f' % ms for ms in [self.last(phase) * 1000,
+                sum(times) / max(len(times), 1), self.percentile(phase, 0.5) * 1000,
+                self.percentile(phase, 0.95) * 1000, times[-1] if times else 0.0]] + histogram)
+        file.close()
+ 
+ 
+class AnsiTerminal:
+    #draws the root console to a terminal with ANSI escape codes, and reads keys and mouse events from it.
+    #only the cells that changed since the last frame are sent, so it's cheap enough to play over SSH.
+ 
+    #escape sequences sent by the terminal for the keys the game uses
+    SEQUENCES = {
+        '\x1b[A': libtcod.KEY_UP, '\x1b[B': libtcod.KEY_DOWN,
+        '\x1b[C': libtcod.KEY_RIGHT, '\x1b[D': libtcod.KEY_LEFT,
+        '\x1b[H': libtcod.KEY_HOME, '\x1b[F': libtcod.KEY_END,
+        '\x1b[1~': libtcod.KEY_HOME, '\x1b[4~': libtcod.KEY_END,
+        '\x1bOH': libtcod.KEY_HOME, '\x1bOF': libtcod.KEY_END,
+        '\x1b[5~': libtcod.KEY_PAGEUP, '\x1b[6~': libtcod.KEY_PAGEDOWN,
+        '\x1b[E': libtcod.KEY_KP5, '\x1b[G': libtcod.KEY_KP5,
+        '\x1bOR': libtcod.KEY_F3, '\x1b[13~': libtcod.KEY_F3, '\x1bOS': libtcod.KEY_F4, '\x1b[14~': libtcod.KEY_F4,
+    }
+    ESCAPE_WAIT = 0.05  #how long a lone ESC waits for the rest of a sequence before it counts as the Escape key
+ 
+    def __init__(self, width, height, input=sys.stdin, output=sys.stdout):
+        self.width = width
+        self.height = height
+        self.input = input
+        self.output = output
+ 
+        #what every cell of the terminal shows right now, None until it's first drawn
+        self.cells = [None] * (width * height)
+        self.touched = [(0, 0, width, height)]  #rectangles of the root console drawn over since the last frame
+        self.cursor = None  #None when the cursor position isn't known
+        self.colors = None  #the (foreground, background) pair currently selected
+ 
+        self.pending = ''  #bytes read from the input that don't make a full event yet
+        self.events = []
+        self.saved_mode = None
+ 
+    def start(self):
+        #read keys one at a time without echo, switch to the alternate screen and ask for mouse reports
+        fd = self.input.fileno()
+        self.saved_mode = termios.tcgetattr(fd)
+        tty.setcbreak(fd)
+        self.output.write('\x1b[?1049h\x1b[?25l\x1b[0m\x1b[2J\x1b[?1003h\x1b[?1006h')
+        self.output.flush()
+ 
+    def stop(self):
+        #put the terminal back the way it was
+        self.output.write('\x1b[?1003l\x1b[?1006l\x1b[0m\x1b[?25h\x1b[?1049l')
+        self.output.flush()
+        if self.saved_mode is not None:
+            termios.tcsetattr(self.input.fileno(), termios.TCSADRAIN, self.saved_mode)
+ 
+    def touch(self, x, y, width, height):
+        #note a rectangle of the root console that may look different next frame, clipped to the screen
+        (x1, y1) = (max(x, 0), max(y, 0))
+        (x2, y2) = (min(x + width, self.width), min(y + height, self.height))
+        if x1 < x2 and y1 < y2:
+            self.touched.append((x1, y1, x2, y2))
+ 
+    def present(self):
+        #compare the touched cells of the root console with what the terminal shows, and send only the
+        #ones that differ. reading a cell back is three calls into libtcod, too many to do for the whole screen
+        indexes = set()
+        for (x1, y1, x2, y2) in self.touched:
+            for y in range(y1, y2):
+                indexes.update(range(y * self.width + x1, y * self.width + x2))
+        self.touched = []
+ 
+        out = []
+        for i in sorted(indexes):
+            (y, x) = divmod(i, self.width)
+            char = libtcod.console_get_char(0, x, y)
+            back = libtcod.console_get_char_background(0, x, y)
+            back = (back.r, back.g, back.b)
+            if char == ord(' '):
+                fore = None  #the foreground of an empty cell doesn't show, don't let it cause a redraw
+            else:
+                fore = libtcod.console_get_char_foreground(0, x, y)
+                fore = (fore.r, fore.g, fore.b)
  
-def player_move_or_attack(dx, dy):
-    global fov_recompute
+            cell = (char, fore, back)
+            if self.cells[i] == cell:
+                continue
+            self.cells[i] = cell
+ 
+            self.move_cursor(out, x, y)
+            self.select_colors(out, fore, back)
+            if 32 <= char < 127:
+                out.append(chr(char))
+            else:
+                out.append(' ')  #outside plain ASCII the font's glyphs have no terminal equivalent
+ 
+            if x + 1 < self.width:
+                self.cursor = (x + 1, y)
+            else:
+                self.cursor = None  #terminals disagree on where the cursor is after the last column
+ 
+        if out:
+            self.output.write(''.join(out))
+            self.output.flush()
+ 
+    def move_cursor(self, out, x, y):
+        #use the shortest sequence that gets the cursor to (x, y)
+        if self.cursor == (x, y):
+            return
+        if self.cursor is not None:
+            (cursor_x, cursor_y) = self.cursor
+            if cursor_y == y and cursor_x < x:
+                out.append('\x1b[' + str(x - cursor_x) + 'C')
+                return
+            if cursor_y + 1 == y and x == 0:
+                out.append('\r\n')
+                return
+        out.append('\x1b[' + str(y + 1) + ';' + str(x + 1) + 'H')
+ 
+    def select_colors(self, out, fore, back):
+        #24-bit colors, only sent when they change
+        if self.colors is not None:
+            (old_fore, old_back) = self.colors
+            if fore is None:
+                fore = old_fore
+        else:
+            (old_fore, old_back) = (None, None)
+ 
+        codes = []
+        if fore is not None and fore != old_fore:
+            codes.append('38;2;%d;%d;%d' % fore)
+        if back != old_back:
+            codes.append('48;2;%d;%d;%d' % back)
+        if codes:
+            out.append('\x1b[' + ';'.join(codes) + 'm')
+        self.colors = (fore, back)
+ 
+    def wait_for_event(self, key, mouse):
+        #sleep until the terminal sends a key or a mouse report, and fill in "key" and "mouse" like libtcod does
+        while not self.events:
+            if self.pending == '\x1b':
+                #the start of a sequence split between two reads (as happens over SSH), or the Escape key
+                if not select.select([self.input], [], [], self.ESCAPE_WAIT)[0]:
+                    self.pending = ''
+                    self.events.append((libtcod.KEY_ESCAPE, 27, None, None, False, False))
+                    break
+            else:
+                select.select([self.input], [], [])
+            self.pending += os.read(self.input.fileno(), 1024)
+            self.parse_input()
+ 
+        (vk, c, cx, cy, lbutton_pressed, rbutton_pressed) = self.events.pop(0)
+        key.vk = vk
+        key.c = c
+        key.pressed = vk != libtcod.KEY_NONE
+        key.lalt = False
+        mouse.lbutton_pressed = lbutton_pressed
+        mouse.rbutton_pressed = rbutton_pressed
+        if cx is not None:
+            (mouse.cx, mouse.cy) = (cx, cy)
+ 
+    def parse_input(self):
+        #turn the bytes read so far into events, leaving an incomplete escape sequence for next time
+        data = self.pending
+        while data:
+            if data.startswith('\x1b[') or data.startswith('\x1bO'):
+                #a control sequence ends at the first byte in the '@' to '~' range
+                end = 2
+                while end < len(data) and not '@' <= data[end] <= '~':
+                    end += 1
+                if end == len(data):
+                    break  #it hasn't fully arrived yet
+                sequence = data[:end + 1]
+                data = data[end + 1:]
+ 
+                if sequence.startswith('\x1b[<'):
+                    #SGR mouse report: ESC [ < button ; x ; y, ending in M when pressed and m when released
+                    try:
+                        (button, x, y) = [int(field) for field in sequence[3:-1].split(';')]
+                    except ValueError:
+                        continue
+                    released = sequence[-1] == 'm'
+                    self.events.append((libtcod.KEY_NONE, 0, x - 1, y - 1,
+                        released and button & 3 == 0, released and button & 3 == 2))
+                elif sequence in self.SEQUENCES:
+                    self.events.append((self.SEQUENCES[sequence], 0, None, None, False, False))
+                #any other sequence is for a key the game doesn't use
+ 
+            elif data == '\x1b':
+                break  #maybe more of a sequence is on its way, wait_for_event sees to it
+            else:
+                char = data[0]
+                data = data[1:]
+                if char == '\x1b':
+                    vk = libtcod.KEY_ESCAPE
+                elif char in '\r\n':
+                    vk = libtcod.KEY_ENTER
+                elif char in '\x7f\x08':
+                    vk = libtcod.KEY_BACKSPACE
+                elif char == ' ':
+                    vk = libtcod.KEY_SPACE
+                else:
+                    vk = libtcod.KEY_CHAR
+                self.events.append((vk, ord(char), None, None, False, False))
+        self.pending = data
+ 
+ 
+class MessageLog:
+    #the game messages, oldest first. they're kept as they were sent and only split among
+    #multiple lines when shown, and a message repeated right away is counted instead of stored again.
+    def __init__(self, max_entries=MSG_HISTORY):
+        self.entries = collections.deque(maxlen=max_entries)  #[text, color, count], old ones drop off the front
+        self.added = 0  #how many entries were ever added, so a save can tell which ones are new
+        self.wrap_cache = {}
+ 
+    def __len__(self):
+        return len(self.entries)
+ 
+    def __getstate__(self):
+        #the wrapped lines aren't worth saving, they're cheap to make again
+        return {'entries': self.entries, 'added': self.added}
+ 
+    def __setstate__(self, state):
+        self.entries = state['entries']
+        self.added = state.get('added', len(self.entries))
+        self.wrap_cache = {}
+ 
+    def add(self, text, color):
+        last = self.entries[-1] if self.entries else None
+        if last is not None and last[0] == text and last[1] == color:
+            last[2] += 1
+        else:
+            self.entries.append([text, color, 1])
+            self.added += 1
+ 
+    def wrap(self, entry, width):
+        #return the lines of an entry split to the given width, remembering the result
+        (text, color, count) = entry
+        if count > 1:
+            text = text + ' (x' + str(count) + ')'
+ 
+        lines = self.wrap_cache.get((text, width))
+        if lines is None:
+            if len(self.wrap_cache) >= 4 * MSG_HEIGHT:
+                self.wrap_cache = {}  #only the latest few are asked for again, a small cache is plenty
+            lines = textwrap.wrap(text, width)
+            self.wrap_cache[(text, width)] = lines
+        return lines
+ 
+    def lines(self, width, height, skip=0):
+        #return the last "height" lines as (line, color) tuples, leaving out the newest "skip" messages.
+        #only the messages that end up on screen are wrapped.
+        result = []
+        for entry in itertools.islice(reversed(self.entries), skip, None):
+            color = entry[1]
+            result[0:0] = [(line, color) for line in self.wrap(entry, width)]
+            if len(result) >= height:
+                break
+        return result[-height:]
  
+def message(new_msg, color = libtcod.white):
+    global msg_version
+    msg_version += 1  #lets the panel know it has to be drawn again
+ 
+    #the message is split among multiple lines only when it's shown
+    game_msgs.add(new_msg, color)
+ 
+def message_history():
+    #show the older messages. the arrow and page keys scroll, any other key closes it
+    finish_loading('messages')
+    width = SCREEN_WIDTH - 10
+    height = SCREEN_HEIGHT - 10
+    window = console_pool.acquire(width, height)
+    try:
+        skip = 0  #how many of the newest messages are scrolled out of view
+        while True:
+            libtcod.console_clear(window)
+            libtcod.console_set_default_foreground(window, libtcod.white)
+            libtcod.console_print_ex(window, 0, 0, libtcod.BKGND_NONE, libtcod.LEFT,
+                'Message history (' + str(len(game_msgs)) + '). Arrows or page keys to scroll, any other key to close.')
+ 
+            y = 2
+            for (line, color) in game_msgs.lines(width, height - 2, skip):
+                libtcod.console_set_default_foreground(window, color)
+                libtcod.console_print_ex(window, 0, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
+                y += 1
+ 
+            x = SCREEN_WIDTH/2 - width/2
+            y = SCREEN_HEIGHT/2 - height/2
+            libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.9)
+            root_changed(x, y, width, height)
+            flush_console()
+ 
+            key = wait_for_keypress()
+            root_changed(x, y, width, height)  #the window is drawn again over the game, or the game over it
+            if key.vk == libtcod.KEY_UP or key.vk == libtcod.KEY_KP8:
+                skip += 1
+            elif key.vk == libtcod.KEY_DOWN or key.vk == libtcod.KEY_KP2:
+                skip -= 1
+            elif key.vk == libtcod.KEY_PAGEUP or key.vk == libtcod.KEY_KP9:
+                skip += height - 2
+            elif key.vk == libtcod.KEY_PAGEDOWN or key.vk == libtcod.KEY_KP3:
+                skip -= height - 2
+            else:
+                break
+            skip = max(0, min(skip, len(game_msgs) - 1))
+    finally:
+        console_pool.release(window)
+ 
+ 
+def player_move_or_attack(dx, dy):
     #the coordinates the player is moving to/attacking
     x = player.x + dx
     y = player.y + dy
@@ -1172,21 +2397,25 @@ def player_move_or_attack(dx, dy):
         player.fighter.attack(target)
     else:
         player.move(dx, dy)
-        fov_recompute = True
  
  
 def menu(header, options, width):
     if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options.')
  
     #calculate total height for the header (after auto-wrap) and one line per option
-    header_height = libtcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
+    header_height = libtcod.console_get_height_rect(0, 0, 0, width, SCREEN_HEIGHT, header)
     if header == '':
         header_height = 0
     height = len(options) + header_height
  
-    #create an off-screen console that represents the menu's window
-    window = libtcod.console_new(width, height)
+    #borrow an off-screen console that represents the menu's window
+    window = console_pool.acquire(width, height)
+    try:
+        return show_menu(window, header, header_height, options, width, height)
+    finally:
+        console_pool.release(window)
  
+def show_menu(window, header, header_height, options, width, height):
     #print the header, with auto-wrap
     libtcod.console_set_default_foreground(window, libtcod.white)
     libtcod.console_print_rect_ex(window, 0, 0, width, height, libtcod.BKGND_NONE, libtcod.LEFT, header)
@@ -1204,10 +2433,12 @@ def menu(header, options, width):
     x = SCREEN_WIDTH/2 - width/2
     y = SCREEN_HEIGHT/2 - height/2
     libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
+    root_changed(x, y, width, height)
  
     #present the root console to the player and wait for a key-press
-    libtcod.console_flush()
-    key = libtcod.console_wait_for_keypress(True)
+    flush_console()
+    key = wait_for_keypress()
+    root_changed(x, y, width, height)  #whatever comes next draws over the window
     if key.vk == libtcod.KEY_ENTER and key.lalt:  #(special case) Alt+Enter: toggle fullscreen
         libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
  
@@ -1218,6 +2449,7 @@ def menu(header, options, width):
  
 def inventory_menu(header):
     #show a menu with each item of the inventory as an option
+    finish_loading('inventory')
     if len(inventory) == 0:
         options = ['You are not carrying anything.']
     else:
@@ -1239,7 +2471,7 @@ def msgbox(text, width=50):
     menu(text, [], width)  #use menu() as a sort of "message box"
  
 def handle_keys():
-    global key
+    global key, show_timings
  
     if key.vk == libtcod.KEY_ENTER and key.lalt:
         #Alt+Enter: toggle fullscreen
@@ -1248,6 +2480,16 @@ def handle_keys():
     elif key.vk == libtcod.KEY_ESCAPE:
         return 'exit'  #exit game
  
+    elif key.vk == libtcod.KEY_F3:
+        #show where the time of a frame goes in the panel, or the messages again
+        show_timings = not show_timings
+        return 'didnt-take-turn'
+ 
+    elif key.vk == libtcod.KEY_F4:
+        frame_times.write_csv(TIMINGS_FILE)
+        message('The frame timings were written to ' + TIMINGS_FILE + '.', libtcod.light_gray)
+        return 'didnt-take-turn'
+ 
     if game_state == 'playing':
         #movement keys
         if key.vk == libtcod.KEY_UP or key.vk == libtcod.KEY_KP8:
@@ -1299,9 +2541,13 @@ def handle_keys():
                     '\nExperience to level up: ' + str(level_up_xp) + '\n\nMaximum HP: ' + str(player.fighter.max_hp) +
                     '\nAttack: ' + str(player.fighter.power) + '\nDefense: ' + str(player.fighter.defense) + '\nLore: ' + str(player.fighter.lore), CHARACTER_SCREEN_WIDTH)
 
+            if key_char == 'm':
+                #show the older messages
+                message_history()
+
             if key_char == 'h':
                 #show the controls
-                msgbox("Controls:\n\n\ng - Pick Up Item\n\ni - View Inventory & Use or Equip Items\n\nd - Drop Item\n\nc - View Player Stats\n\n< - Go Down Stairs\n\n> - Go Up Stairs\n\nh - View Command List\n\nEsc - Bring Up Game Menu\n\nAlt+Enter - Toggle Full Screen\n\n\nEquip items from the inventory screen. Automatic de-equippping occurs if an item already occupies the slot you are trying to equip to.", CHARACTER_SCREEN_WIDTH)
+                msgbox("Controls:\n\n\ng - Pick Up Item\n\ni - View Inventory & Use or Equip Items\n\nd - Drop Item\n\nc - View Player Stats\n\nm - View Message History\n\n< - Go Down Stairs\n\n> - Go Up Stairs\n\nh - View Command List\n\nEsc - Bring Up Game Menu\n\nAlt+Enter - Toggle Full Screen\n\nF3 - Show Frame Timings\n\nF4 - Write Frame Timings to " + TIMINGS_FILE + "\n\n\nEquip items from the inventory screen. Automatic de-equippping occurs if an item already occupies the slot you are trying to equip to.", CHARACTER_SCREEN_WIDTH)
 
             if key_char == '<':
                 #go down stairs, if the player is on them
@@ -1310,13 +2556,13 @@ def handle_keys():
 
             if key_char == '>':
                 #go up stairs, if the player is on them
-                if upstairs.x == player.x and upstairs.y == player.y:
+                if upstairs is not None and upstairs.x == player.x and upstairs.y == player.y:
                     previous_level()
  
             return 'didnt-take-turn'
  
-def check_level_up():
-        #see if the player's experience is enough to level-up
+def check_level_up(choice=None):
+        #see if the player's experience is enough to level-up. the stat to raise is asked for, unless it's given
         level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
         if player.fighter.xp >= level_up_xp:
             player.level += 1
@@ -1325,7 +2571,6 @@ def check_level_up():
             # Change this message to something more game world appropriate:
             message('Your battle skills grow stronger! You reached level ' + str(player.level) + '!', libtcod.yellow)
 
-            choice = None
             while choice == None:  #keep asking until a choice is made
                 choice = menu('Level up! Choose a stat to raise:\n',
                     ['Constitution (+20 HP, from ' + str(player.fighter.max_hp) + ')',
@@ -1342,6 +2587,8 @@ def check_level_up():
                 player.fighter.base_defense += 1
             elif choice == 3:
                 player.fighter.base_lore += 1
+            return True
+        return False
 
 def player_death(player):
     #the game ended!
@@ -1370,9 +2617,11 @@ def target_tile(max_range=None):
     global key, mouse
     while True:
         #render the screen. this erases the inventory and shows the names of objects under the mouse.
-        libtcod.console_flush()
-        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse) 
         render_all()
+        flush_console()
+ 
+        #sleep until the player clicks, presses a key or moves the mouse
+        wait_for_event(key, mouse)
         (x, y) = (mouse.cx, mouse.cy)
         (x, y) = (camera_x + x, camera_y + y)  #from screen to map coordinates
  
@@ -1380,7 +2629,7 @@ def target_tile(max_range=None):
             return (None, None)  #cancel if the player right-clicked or pressed Escape
  
         #accept the target if the player clicked in FOV, and in case a range is specified, if it's in that range
-        if (mouse.lbutton_pressed and libtcod.map_is_in_fov(fov_map, x, y) and
+        if (mouse.lbutton_pressed and in_fov(x, y) and
             (max_range is None or player.distance(x, y) <= max_range)):
             return (x, y)
  
@@ -1402,7 +2651,7 @@ def closest_monster(max_range):
     closest_dist = max_range + 1  #start with (slightly more than) maximum range
  
     for object in objects:
-        if object.fighter and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
+        if object.fighter and not object == player and in_fov(object.x, object.y):
             #calculate distance between this object and the player
             dist = player.distance_to(object)
             if dist < closest_dist:  #it's closer, so remember it
@@ -1412,7 +2661,7 @@ def closest_monster(max_range):
  
 def cast_poison():
     #poison the player
-    poison_amount = libtcod.random_get_int(0, 5, 20)
+    poison_amount = libtcod.random_get_int(rng, 5, 20)
     message('The poition was poisoned, you take '+str(poison_amount)+' poison damage!', libtcod.red)
     player.fighter.heal(poison_amount)
 
@@ -1421,7 +2670,7 @@ def cast_heal():
     if player.fighter.hp == player.fighter.max_hp:
         message('You are already at full health.', libtcod.red)
         return 'cancelled'
-    heal_amount = libtcod.random_get_int(0, 10, 40)
+    heal_amount = libtcod.random_get_int(rng, 10, 40)
     message('Your wounds start to feel better!', libtcod.light_violet)
     player.fighter.heal(heal_amount)
  
@@ -1474,47 +2723,843 @@ def cast_confuse():
         return 'cancelled'
         
  
+#the binary save format. a file starts with SAVE_MAGIC and SAVE_VERSION, then (since version 2) a byte for
+#the compression the rest of the file went through, followed by sections that are each a 4 letter tag,
+#the length of their contents and the contents.
+SAVE_HEADER = struct.Struct('<4sH')
+SECTION_HEADER = struct.Struct('<4sI')
+CODECS = ['none', 'zlib', 'lzma']  #by the byte saved for them
+READ_SIZE = 65536  #how much of a compressed file is read in at a time
+ 
+#the journal starts with JOURNAL_MAGIC, SAVE_VERSION and the id of the save file it belongs to (its JRNL section),
+#followed by an ENTR section for each save since, holding the sections that changed. besides replacing whole
+#sections of the save file an entry can hold EXPL, the newly explored tiles, MSGT, the newest messages, and OBJD
+#and INVD, the objects and inventory items that changed (see pack_object_delta). version 1 journals had no deltas.
+JOURNAL_MAGIC = 'CCJN'
+JOURNAL_VERSION = 2
+OBJECT_DELTAS = [('OBJS', 'OBJD'), ('INVT', 'INVD')]  #the tables of objects journaled record by record
+JOURNAL_HEADER = struct.Struct('<4sHI')
+JOURNAL_LIMIT = 0.5  #once the journal is this big compared to the save file, the two are folded into a new save file
+ 
+#the map is one byte of these flags per tile, column by column like "map" itself, then a bitmap of the explored tiles.
+#it's stored run-length encoded in the TILE section, save files before version 2 have it as it is in MAP.
+TILE_BLOCKED = 1
+TILE_BLOCK_SIGHT = 2
+TILE_EXPLORED = 4  #only in chunks stored whole (ChunkStore and the level store), which have no bitmap
+TILE_FLAGS = dict((tile, blocked * TILE_BLOCKED | block_sight * TILE_BLOCK_SIGHT | explored * TILE_EXPLORED)
+    for ((blocked, block_sight, explored), tile) in TILES.items())
+FLAG_TILES = dict((flags, tile) for (tile, flags) in TILE_FLAGS.items())
+TILE_ID_FLAGS = dict((id(tile), flags) for (tile, flags) in TILE_FLAGS.items())  #hashing a tile itself is slow
+ 
+def tile_flags(tiles):
+    #a bytearray of the TILE_FLAGS of some tiles, and map_tiles the other way round. neither loops in Python
+    return bytearray(itertools.imap(TILE_ID_FLAGS.__getitem__, itertools.imap(id, tiles)))
+ 
+def map_tiles(flags):
+    return list(itertools.imap(FLAG_TILES.__getitem__, flags))
+ 
+SOLID_FLAGS = str(tile_flags(SOLID_CHUNK))
+ 
+#an object is a fixed size record, followed by the optional parts its flags ask for. the OIDX section
+#holds where each record of OBJS starts, so a record can be unpacked without going through the ones before it.
+#other sections refer to objects by id, 0 standing for none.
+OBJECT_RECORD = struct.Struct('<IHHHBBBBB')  #id, template id, x, y, char, color r, g, b, flags
+OLD_OBJECT_RECORD = struct.Struct('<HHHBBBBB')  #the same without the id, in save files before version 3
+REFS_RECORD = struct.Struct('<IIII')  #the ids of the player, the stairs and the upstairs, and the next id to give out
+FIGHTER_RECORD = struct.Struct('<6i')  #hp, base max hp, base defense, base power, base lore, xp
+OBJECT_BLOCKS = 1
+OBJECT_ALWAYS_VISIBLE = 2
+OBJECT_FIGHTER = 4
+OBJECT_EQUIPPED = 8
+OBJECT_NAME = 16  #its name isn't the one its template gives it
+OBJECT_LEVEL = 32
+ 
+AI_NONE = 0
+AI_BASIC = 1
+AI_CONFUSED = 2  #followed by the number of turns left and the AI to go back to
+ 
+template_names = {}
+ 
+def new_compressor(codec):
+    if codec == 'zlib':
+        return zlib.compressobj(6)
+    if codec == 'lzma':
+        return lzma.LZMACompressor()
+    return None
+ 
+def new_decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    if codec == 'lzma':
+        return lzma.LZMADecompressor()
+    return None
+ 
+def write_sections(path, sections, codec='none'):
+    #write a save file from a list of (tag, contents), compressing it on the way. it goes to a temporary
+    #file first, so a crash halfway through can't leave a broken save behind
+    temp = path + '.tmp'
+    file = open(temp, 'wb')
+    file.write(SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION) + chr(CODECS.index(codec)))
+ 
+    compressor = new_compressor(codec)
+    for (tag, contents) in sections:
+        for part in (SECTION_HEADER.pack(tag, len(contents)), contents):
+            if compressor is not None:
+                part = compressor.compress(part)
+            file.write(part)
+    if compressor is not None:
+        file.write(compressor.flush())
+    sync_and_close(file)
+ 
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temp, path)
+ 
+def sync_and_close(file):
+    #make sure the file really is on the disk before going on, so a crash can't lose it
+    file.flush()
+    os.fsync(file.fileno())
+    file.close()
+ 
+def read_sections(path):
+    #read a save file back, as a dictionary of the contents of each section by tag. the file is read and
+    #decompressed a piece at a time, and each section taken out as soon as all of it is there
+    file = open(path, 'rb')
+    try:
+        #returns the version of the file too, as (version, sections)
+        (magic, version) = SAVE_HEADER.unpack(file.read(SAVE_HEADER.size))
+        if magic != SAVE_MAGIC or version > SAVE_VERSION:
+            raise ValueError(path + ' is not a save file this version of the game can read')
+        codec = 'none'
+        if version >= 2:
+            codec = CODECS[ord(file.read(1))]
+        decompressor = new_decompressor(codec)
+ 
+        sections = {}
+        pending = ''
+        while True:
+            data = file.read(READ_SIZE)
+            if not data:
+                break
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            pending += data
+ 
+            while len(pending) >= SECTION_HEADER.size:
+                (tag, length) = SECTION_HEADER.unpack_from(pending)
+                end = SECTION_HEADER.size + length
+                if len(pending) < end:
+                    break  #the rest of it is still to come
+                sections[tag] = pending[SECTION_HEADER.size:end]
+                pending = pending[end:]
+        return (version, sections)
+    finally:
+        file.close()
+ 
+def sections_size(sections):
+    #how big a save file with these sections is before compression
+    return SAVE_HEADER.size + 1 + sum(SECTION_HEADER.size + len(contents) for contents in sections)
+ 
+def split_sections(data, offset=0):
+    #return the (tag, contents) of the sections in data, leaving out a last one that was cut short
+    sections = []
+    while offset + SECTION_HEADER.size <= len(data):
+        (tag, length) = SECTION_HEADER.unpack_from(data, offset)
+        offset += SECTION_HEADER.size
+        if offset + length > len(data):
+            break
+        sections.append((tag, data[offset:offset + length]))
+        offset += length
+    return sections
+ 
+RUNS = re.compile(r'(.)\1*', re.DOTALL)
+ 
+def rle_encode(data):
+    #the runs of the same byte in data as pairs of a length of up to 255 and the byte.
+    #the map is mostly long runs of wall and unexplored tiles, so this shrinks it a lot before compression
+    runs = []
+    for match in RUNS.finditer(data):
+        (length, byte) = (match.end() - match.start(), match.group(1))
+        while length > 255:
+            runs.append('\xff' + byte)
+            length -= 255
+        runs.append(chr(length) + byte)
+    return ''.join(runs)
+ 
+def rle_decode(data):
+    return ''.join(itertools.imap(operator.mul, data[1::2], bytearray(data[0::2])))
+ 
+def pack_string(text):
+    return struct.pack('<H', len(text)) + text
+ 
+def unpack_string(data, offset):
+    (length,) = struct.unpack_from('<H', data, offset)
+    offset += 2
+    return (data[offset:offset + length], offset + length)
+ 
+def pack_map(width, height, chunks):
+    #the tile flags of the whole map, then the explored bitmap, from a snapshot of its chunks
+    flags = map_flags(width, height, chunks)
+    return struct.pack('<HH', width, height) + flags.translate(SAVED_FLAGS) + pack_bits(flags.translate(EXPLORED_BITS))
+ 
+def map_flags(width, height, chunks):
+    #the TILE_FLAGS of every tile of a map, column by column
+    chunk_flags = [[SOLID_FLAGS if chunk is SOLID_CHUNK else str(tile_flags(chunk)) for chunk in column]
+        for column in chunks]
+    columns = []
+    for x in range(width):
+        offset = (x & CHUNK_MASK) << CHUNK_SHIFT
+        columns.append(''.join(flags[offset:offset + CHUNK_SIZE] for flags in chunk_flags[x >> CHUNK_SHIFT])[:height])
+    return ''.join(columns)
+ 
+SAVED_FLAGS = ''.join(chr(flags & ~TILE_EXPLORED) for flags in range(256))  #str.translate tables
+EXPLORED_BITS = ''.join('1' if flags & TILE_EXPLORED else '0' for flags in range(256))
+EXPLORED_FLAGS = ''.join(chr(TILE_EXPLORED) if chr(byte) == '1' else '\0' for byte in range(256))
+ 
+def pack_bits(bits):
+    #a string of '0' and '1' as a bitmap, the first one going in the lowest bit of the first byte. it's read as
+    #one big binary number, which python converts without a loop of its own
+    size = (len(bits) + 7) / 8
+    return binascii.unhexlify('%0*x' % (size * 2, int(bits[::-1] or '0', 2)))[::-1]
+ 
+def unpack_bits(bitmap, count):
+    #the first "count" bits of a bitmap as pack_bits leaves it
+    return bin(int(binascii.hexlify(bitmap[::-1]) or '0', 16))[2:].zfill(len(bitmap) * 8)[::-1][:count]
+ 
+def add_explored(flags, explored):
+    #the tile flags with TILE_EXPLORED added to the tiles set in the explored bitmap. the two are or'ed together
+    #as big numbers, like pack_bits does
+    bits = unpack_bits(explored, len(flags)).translate(EXPLORED_FLAGS)
+    return binascii.unhexlify('%0*x' % (len(flags) * 2,
+        int(binascii.hexlify(flags), 16) | int(binascii.hexlify(bits), 16)))
+ 
+def unpack_map(data):
+    #the map is made chunk by chunk from slices of the flags, as in load_level. the chunks that are all solid rock
+    #are left as SOLID_CHUNK, so a big level that's mostly rock is quick to load
+    (width, height) = struct.unpack_from('<HH', data)
+    flags = add_explored(data[4:4 + width * height], data[4 + width * height:])
+    solid = SOLID_FLAGS[0]
+ 
+    map = ChunkedMap(width, height)
+    for (cx, column) in enumerate(map.chunks):
+        starts = [x * height for x in range(cx << CHUNK_SHIFT, min((cx + 1) << CHUNK_SHIFT, width))]
+        for cy in range(len(column)):
+            (y1, y2) = (cy << CHUNK_SHIFT, min((cy + 1) << CHUNK_SHIFT, height))
+            chunk = ''.join(flags[start + y1:start + y2].ljust(CHUNK_SIZE, solid) for start in starts)
+            chunk = chunk.ljust(CHUNK_SIZE * CHUNK_SIZE, solid)
+            if chunk != SOLID_FLAGS:
+                column[cy] = map_tiles(bytearray(chunk))
+    return map
+ 
+def template_name(template):
+    #the name a new object of this kind gets
+    if template not in template_names:
+        template_names[template] = make_object(template, 0, 0).name
+    return template_names[template]
+ 
+def pack_ai(ai):
+    if ai is None:
+        return chr(AI_NONE)
+    if isinstance(ai, ConfusedMonster):
+        return chr(AI_CONFUSED) + struct.pack('<H', ai.num_turns) + pack_ai(ai.old_ai)
+    return chr(AI_BASIC)
+ 
+def unpack_ai(data, offset, owner):
+    kind = ord(data[offset])
+    offset += 1
+    if kind == AI_NONE:
+        return (None, offset)
+ 
+    if kind == AI_CONFUSED:
+        (num_turns,) = struct.unpack_from('<H', data, offset)
+        (old_ai, offset) = unpack_ai(data, offset + 2, owner)
+        ai = ConfusedMonster(old_ai, num_turns)
+    else:
+        ai = BasicMonster()
+    ai.owner = owner
+    return (ai, offset)
+ 
+def pack_object(obj):
+    #a record of the object's template and everything about it that can differ from a new one
+    flags = 0
+    if obj.blocks:
+        flags |= OBJECT_BLOCKS
+    if getattr(obj, 'always_visible', False):
+        flags |= OBJECT_ALWAYS_VISIBLE
+    if obj.fighter:
+        flags |= OBJECT_FIGHTER
+    if obj.equipment and obj.equipment.is_equipped:
+        flags |= OBJECT_EQUIPPED
+    if obj.name != template_name(obj.template):
+        flags |= OBJECT_NAME
+    if hasattr(obj, 'level'):
+        flags |= OBJECT_LEVEL
+ 
+    record = [OBJECT_RECORD.pack(obj.id, TEMPLATE_IDS[obj.template], obj.x, obj.y, ord(obj.char),
+        obj.color.r, obj.color.g, obj.color.b, flags)]
+    if flags & OBJECT_NAME:
+        record.append(pack_string(obj.name))
+    if flags & OBJECT_FIGHTER:
+        fighter = obj.fighter
+        record.append(FIGHTER_RECORD.pack(fighter.hp, fighter.base_max_hp, fighter.base_defense,
+            fighter.base_power, fighter.base_lore, fighter.xp))
+    record.append(pack_ai(obj.ai))
+    if flags & OBJECT_LEVEL:
+        record.append(struct.pack('<H', obj.level))
+    return ''.join(record)
+ 
+def unpack_object(data, offset, record=OBJECT_RECORD):
+    #make a new object from its template, then put back everything the record says is different
+    fields = record.unpack_from(data, offset)
+    offset += record.size
+    if record is OLD_OBJECT_RECORD:
+        fields = (None,) + fields  #it keeps the id it was just given
+    (object_id, template_id, x, y, char, r, g, b, flags) = fields
+ 
+    obj = make_object(TEMPLATES[template_id], x, y)
+    if object_id is not None:
+        obj.id = object_id
+    obj.char = chr(char)
+    obj.color = libtcod.Color(r, g, b)
+    obj.blocks = flags & OBJECT_BLOCKS != 0
+    if flags & OBJECT_ALWAYS_VISIBLE:
+        obj.always_visible = True
+    if flags & OBJECT_NAME:
+        (obj.name, offset) = unpack_string(data, offset)
+ 
+    if flags & OBJECT_FIGHTER:
+        fighter = obj.fighter
+        (fighter.hp, fighter.base_max_hp, fighter.base_defense, fighter.base_power, fighter.base_lore,
+            fighter.xp) = FIGHTER_RECORD.unpack_from(data, offset)
+        offset += FIGHTER_RECORD.size
+    else:
+        obj.fighter = None  #it was killed
+ 
+    (obj.ai, offset) = unpack_ai(data, offset, obj)
+    if obj.equipment:
+        obj.equipment.is_equipped = flags & OBJECT_EQUIPPED != 0
+    if flags & OBJECT_LEVEL:
+        (obj.level,) = struct.unpack_from('<H', data, offset)
+        offset += 2
+    return (obj, offset)
+ 
+def pack_objects(objects):
+    return pack_records([pack_object(obj) for obj in objects])[0]
+ 
+def pack_records(records):
+    #the table of objects made of records from pack_object, and its index
+    offsets = []
+    offset = 4
+    for record in records:
+        offsets.append(offset)
+        offset += len(record)
+    return (struct.pack('<I', len(records)) + ''.join(records), struct.pack('<%dI' % len(offsets), *offsets))
+ 
+def object_records(objects):
+    #the record of each object by its id, in order
+    return collections.OrderedDict((obj.id, pack_object(obj)) for obj in objects)
+ 
+def record_offsets(data, record=OBJECT_RECORD):
+    #where each record of a table of objects starts, for a table without an index
+    (count,) = struct.unpack_from('<I', data)
+    offsets = []
+    offset = 4
+    for i in range(count):
+        offsets.append(offset)
+        offset = object_end(data, offset, record)
+    return offsets
+ 
+def object_end(data, offset, record=OBJECT_RECORD):
+    #where the record of an object that starts at offset ends, found without unpacking it
+    flags = ord(data[offset + record.size - 1])
+    offset += record.size
+    if flags & OBJECT_NAME:
+        offset += 2 + struct.unpack_from('<H', data, offset)[0]
+    if flags & OBJECT_FIGHTER:
+        offset += FIGHTER_RECORD.size
+    while ord(data[offset]) == AI_CONFUSED:
+        offset += 3  #the turns left, then the AI to go back to
+    offset += 1
+    if flags & OBJECT_LEVEL:
+        offset += 2
+    return offset
+ 
+def split_object_table(data, offsets=None, record=OBJECT_RECORD):
+    #the records of a table of objects by id, in order
+    if offsets is None:
+        offsets = record_offsets(data, record)
+    ends = list(offsets[1:]) + [len(data)]
+    return collections.OrderedDict((struct.unpack_from('<I', data, start)[0], data[start:end])
+        for (start, end) in zip(offsets, ends))
+ 
+def unpack_index(index):
+    return struct.unpack('<%dI' % (len(index) / 4), index)
+ 
+def pack_object_delta(old, new):
+    #how to get from one table of records by id to another: the records that are new or differ, the ids of the
+    #objects that are gone, and the order of all the ids if it isn't the one that leaves (new ones go at the end).
+    #returns None if nothing changed. a monster that moved is a record of its own, not the whole table
+    changed = [record for (obj_id, record) in new.iteritems() if old.get(obj_id) != record]
+    removed = [obj_id for obj_id in old if obj_id not in new]
+    order = new.keys()
+    if [obj_id for obj_id in old if obj_id in new] + [obj_id for obj_id in new if obj_id not in old] == order:
+        order = []
+    if not (changed or removed or order):
+        return None
+    return (struct.pack('<III', len(changed), len(removed), len(order)) +
+        ''.join(struct.pack('<I', len(record)) + record for record in changed) +
+        struct.pack('<%dI' % len(removed), *removed) + struct.pack('<%dI' % len(order), *order))
+ 
+def apply_object_delta(records, delta):
+    #change a table of records by id as pack_object_delta says
+    (changed, removed, ordered) = struct.unpack_from('<III', delta)
+    offset = 12
+    for i in range(changed):
+        (length,) = struct.unpack_from('<I', delta, offset)
+        record = delta[offset + 4:offset + 4 + length]
+        records[struct.unpack_from('<I', record)[0]] = record
+        offset += 4 + length
+    for obj_id in struct.unpack_from('<%dI' % removed, delta, offset):
+        del records[obj_id]
+    offset += removed * 4
+    if ordered:
+        order = struct.unpack_from('<%dI' % ordered, delta, offset)
+        items = [(obj_id, records[obj_id]) for obj_id in order]
+        records.clear()
+        records.update(items)
+ 
+def unpack_objects(data, record=OBJECT_RECORD):
+    (count,) = struct.unpack_from('<I', data)
+    offset = 4
+    objects = []
+    for i in range(count):
+        (obj, offset) = unpack_object(data, offset, record)
+        objects.append(obj)
+    return objects
+ 
+def pack_messages(entries):
+    #the message log is small and only read when a game is loaded, so it's simply pickled
+    entries = [(text, (color.r, color.g, color.b), count) for (text, color, count) in entries]
+    return pickle.dumps(entries, pickle.HIGHEST_PROTOCOL)
+ 
+def unpack_messages(entries):
+    #turn entries as pack_messages leaves them back into ones for the message log
+    return [[text, libtcod.Color(r, g, b), count] for (text, (r, g, b), count) in entries]
+ 
+def game_snapshot():
+    #what can change of the game while the player stays on the same level, as it is now: the small sections packed,
+    #the objects and the inventory as their records by id. game_sections makes the sections of the rest
+    return {
+        'GAME': struct.pack('<HH', dungeon_level, MAX_ROOMS) + pack_string(game_state),
+        'OBJS': object_records(objects),
+        'INVT': object_records(inventory),
+        'REFS': REFS_RECORD.pack(player.id, stairs.id, upstairs.id if upstairs else 0, object_ids.peek()),
+    }
+ 
+def game_sections(snapshot):
+    #the sections of the save file for a snapshot from game_snapshot
+    (objects_data, objects_index) = pack_records(snapshot['OBJS'].values())
+    return [
+        ('GAME', snapshot['GAME']),
+        ('OBJS', objects_data),
+        ('OIDX', objects_index),
+        ('INVT', pack_records(snapshot['INVT'].values())[0]),
+        ('REFS', snapshot['REFS']),
+    ]
+ 
+def remember_saved(snapshot, save_size, journal_size):
+    #keep what's now saved, so the next save can write only what differs from it. save_writer adds the sizes of
+    #what it writes as it goes
+    global journal_state
+    map.explored_cells = []
+    journal_state = {'map': map, 'snapshot': snapshot, 'msg_version': msg_version, 'msg_added': game_msgs.added,
+        'save_size': save_size, 'journal_size': journal_size}
+    return journal_state
+ 
 def save_game():
-    #open a new empty shelve (possibly overwriting an old one) to write the game data
-    file = shelve.open('savegame', 'n')
-    file['map'] = map
-    file['objects'] = objects
-    file['player_index'] = objects.index(player)  #index of player in objects list
-    file['inventory'] = inventory
-    file['game_msgs'] = game_msgs
-    file['game_state'] = game_state
-    file['stairs_index'] = objects.index(stairs)
-    file['upstairs_index'] = objects.index(upstairs)
-    file['dungeon_level'] = dungeon_level
+    #save the game and wait until it's on disk, as when quitting
+    save_writer.wait()
+    job = prepare_save()
+    save_writer.wait()  #the chunks of an endless cave it handed over, which the save file points to
+    write_save_job(job)
+ 
+def autosave():
+    #save the game without waiting for the disk: only a snapshot of the game is taken right away, packing and
+    #writing it is left to save_writer
+    if save_writer.error is not None:
+        message('The game could not be saved: ' + str(save_writer.error), libtcod.red)
+    save_writer.put(prepare_save())
+ 
+def prepare_save():
+    #take what has to be written to save the game as it is now. as long as the player is on the level the save
+    #file holds, that's only what changed since the last save, to be added to the journal; once that grows too
+    #big, it's the whole game for a new save file
+    global journal_state
+    finish_loading()
+    if save_writer.error is not None:
+        save_writer.error = None
+        journal_state = None  #the last save didn't make it to disk, so start over
+ 
+    state = journal_state
+    if (state is None or state['map'] is not map or state['journal_size'] > JOURNAL_LIMIT * state['save_size'] or
+            isinstance(map, StreamedMap)):  #its explored tiles aren't kept in a bitmap, there's no journal for it
+        return prepare_whole_save()
+    return prepare_journal_entry()
+ 
+def prepare_whole_save():
+    save_id = struct.unpack('<I', os.urandom(4))[0]
+    if isinstance(map, StreamedMap):
+        #an endless cave is too big to save whole. the chunks in memory go to its store without their objects,
+        #which the save file has, and the save file keeps where the chunks are in it
+        stream_around_player()
+        map.flush()
+        tiles = ('STRM', map.pack_index())
+    else:
+        tiles = ('TILE', map.width, map.height, map.snapshot())
+    snapshot = game_snapshot()
+    messages = pack_messages(game_msgs.entries)
+    state = remember_saved(snapshot, 0, 0)  #nothing is on disk until save_writer gets to it
+    return ('save', state, tiles, snapshot, messages, save_id, SAVE_COMPRESSION)
+ 
+def prepare_journal_entry():
+    #the snapshot the last save was made from goes along, for save_writer to find out what changed since
+    state = journal_state
+    (old, snapshot) = (state['snapshot'], game_snapshot())
+    if old is None:
+        #the game as load_game found it. its records are only split out of the save file now
+        (sections, offsets, inventory_offsets) = state.pop('saved')
+        old = {'GAME': sections['GAME'], 'REFS': sections['REFS'], 'OBJS': split_object_table(sections['OBJS'], offsets),
+            'INVT': split_object_table(sections['INVT'], inventory_offsets)}
+    cells = map.explored_cells
+    map.explored_cells = []
+ 
+    messages = []
+    if msg_version != state['msg_version']:
+        new = game_msgs.added - state['msg_added']
+        if new >= len(game_msgs):
+            messages.append(('MSGS', pack_messages(game_msgs.entries)))  #everything in the log is new
+        else:
+            #the messages added since, and the one before them whose count may have gone up
+            tail = itertools.islice(game_msgs.entries, len(game_msgs) - new - 1, None)
+            messages.append(('MSGT', pack_messages(tail)))
+ 
+    state.update(snapshot=snapshot, msg_version=msg_version, msg_added=game_msgs.added)
+    return ('journal', state, old, snapshot, cells, messages)
+ 
+def pack_journal_entry(old, new, cells, messages):
+    #the sections of a journal entry between two snapshots from game_snapshot, packed together.
+    #the objects and the inventory go only by the records that changed
+    entry = [(tag, new[tag]) for tag in ('GAME', 'REFS') if new[tag] != old[tag]]
+    for (table, tag) in OBJECT_DELTAS:
+        delta = pack_object_delta(old[table], new[table])
+        if delta is not None:
+            entry.append((tag, delta))
+    if cells:
+        entry.append(('EXPL', struct.pack('<%dI' % len(cells), *cells)))
+    entry.extend(messages)
+    return ''.join(SECTION_HEADER.pack(tag, len(contents)) + contents for (tag, contents) in entry)
+ 
+def write_save_job(job):
+    #pack and write what prepare_save took: either a new save file with an empty journal, or an entry for the
+    #journal. the journal isn't compressed, its entries are small and have to be appended one by one
+    if job[0] == 'chunks':
+        #chunks of an endless cave, see ChunkStore
+        (kind, store, offset, records, sync) = job
+        store.write_now(offset, records, sync)
+        return
+    if job[0] == 'save':
+        (kind, state, tiles, snapshot, messages, save_id, codec) = job
+        if tiles[0] == 'TILE':
+            (tag, width, height, chunks) = tiles
+            tiles = (tag, rle_encode(pack_map(width, height, chunks)))
+        sections = [tiles] + game_sections(snapshot) + [('MSGS', messages), ('JRNL', struct.pack('<I', save_id))]
+        write_sections(SAVE_FILE, sections, codec)
+        file = open(SAVE_JOURNAL, 'wb')
+        file.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, save_id))
+        sync_and_close(file)
+        state['save_size'] = sections_size(contents for (tag, contents) in sections)
+        state['journal_size'] = JOURNAL_HEADER.size
+    else:
+        (kind, state, old, new, cells, messages) = job
+        data = pack_journal_entry(old, new, cells, messages)
+        if not data:
+            return  #nothing changed
+        file = open(SAVE_JOURNAL, 'ab')
+        file.write(SECTION_HEADER.pack('ENTR', len(data)))
+        file.write(data)
+        sync_and_close(file)
+        state['journal_size'] += SECTION_HEADER.size + len(data)
+ 
+class SaveWriter:
+    #writes saves on a thread of its own, one after another in the order they were made, so the game never
+    #waits on the disk. the thread doesn't hold up quitting; a save it was writing is simply lost, since a save
+    #file is only renamed into place once it's complete and a journal entry cut short is ignored
+    def __init__(self):
+        self.jobs = Queue.Queue()
+        self.thread = None
+        self.error = None  #why the last save failed, if it did
+ 
+    def put(self, job):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='save writer')
+            self.thread.daemon = True
+            self.thread.start()
+        self.jobs.put(job)
+ 
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                write_save_job(job)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()  #or wait would never return
+ 
+    def wait(self):
+        #block until all the saves handed over so far are written
+        self.jobs.join()
+ 
+def read_journal(sections):
+    #return the entries of the journal that belongs to the save file with these sections, as lists of (tag, contents).
+    #returns None if there's no such journal
+    if 'JRNL' not in sections or not os.path.exists(SAVE_JOURNAL):
+        return None
+ 
+    file = open(SAVE_JOURNAL, 'rb')
+    data = file.read()
     file.close()
  
+    if len(data) < JOURNAL_HEADER.size:
+        return None
+    (magic, version, save_id) = JOURNAL_HEADER.unpack_from(data)
+    if (magic != JOURNAL_MAGIC or version not in (1, JOURNAL_VERSION) or
+            save_id != struct.unpack('<I', sections['JRNL'])[0]):
+        return None  #left over from another save
+ 
+    #an entry cut short by a crash is left out
+    return [split_sections(contents) for (tag, contents) in split_sections(data, JOURNAL_HEADER.size)]
+ 
 def load_game():
-    #open the previously saved shelve and load the game data
-    global map, objects, player, stairs, inventory, game_msgs, game_state, dungeon_level, upstairs
+    #open the previously saved game, along with the changes in its journal. only what the first frame shows is
+    #loaded right away: the map, the player, the stairs and the objects the player can see, the equipped items
+    #(they count towards the stats on the panel) and the messages on the panel. the rest is left for
+    #finish_loading, until something first needs it
+    global map, objects, player, stairs, inventory, game_msgs, msg_version, game_state, dungeon_level, upstairs
+    global MAX_ROOMS, MAP_WIDTH, MAP_HEIGHT, journal_state, pending_load, endless_caves
+ 
+    save_writer.wait()  #an autosave may still be on its way
+    pending_load = None
+    input_log.saved_files([SAVE_FILE, SAVE_JOURNAL] + level_files())
+    if not os.path.exists(SAVE_FILE):
+        load_legacy_game()
+        return
+ 
+    (version, sections) = read_sections(SAVE_FILE)
+    save_size = sections_size(sections.values())
+    journal = read_journal(sections)
+    record = OBJECT_RECORD if version >= 3 else OLD_OBJECT_RECORD
+ 
+    #later sections replace earlier ones, while explored tiles and new messages pile up, and the objects and the
+    #inventory change record by record
+    explored_cells = []
+    message_tails = []
+    tables = {}  #the records by id of the tables with deltas, until they're packed again below
+    deltas = dict((tag, table) for (table, tag) in OBJECT_DELTAS)
+    for entry in journal or []:
+        for (tag, contents) in entry:
+            if tag == 'EXPL':
+                explored_cells.extend(struct.unpack('<%dI' % (len(contents) / 4), contents))
+            elif tag == 'MSGT':
+                message_tails.append(contents)
+            elif tag in deltas:
+                table = deltas[tag]
+                if table not in tables:
+                    index = unpack_index(sections['OIDX']) if table == 'OBJS' else None
+                    tables[table] = split_object_table(sections[table], index, record)
+                apply_object_delta(tables[table], contents)
+            else:
+                sections[tag] = contents
+                tables.pop(tag, None)
+                if tag == 'MSGS':
+                    message_tails = []
+    for (table, records) in tables.items():
+        (sections[table], index) = pack_records(records.values())
+        if table == 'OBJS':
+            sections['OIDX'] = index
+ 
+    (dungeon_level, MAX_ROOMS) = struct.unpack_from('<HH', sections['GAME'])
+    (game_state, offset) = unpack_string(sections['GAME'], 4)
+ 
+    if 'STRM' in sections:
+        (map, MAP_WIDTH, MAP_HEIGHT) = unpack_streamed_map(sections['STRM'])
+        endless_caves = True  #the game was started with --endless-caves
+    else:
+        if 'TILE' in sections:
+            map = unpack_map(rle_decode(sections['TILE']))
+        else:
+            map = unpack_map(sections['MAP '])
+        (MAP_WIDTH, MAP_HEIGHT) = (len(map), len(map[0]))
+    for i in explored_cells:
+        map.explore(i / map.height, i % map.height)
+ 
+    #the objects the first frame needs: the player, the stairs, and what the player can see
+    objects_data = sections['OBJS']
+    if 'OIDX' in sections:
+        offsets = unpack_index(sections['OIDX'])
+    else:
+        offsets = record_offsets(objects_data, record)  #saved before there was an index
+ 
+    #where the player and the stairs are among the records
+    if version >= 3:
+        (player_id, stairs_id, upstairs_id, next_id) = REFS_RECORD.unpack(sections['REFS'])
+        indices = dict((struct.unpack_from('<I', objects_data, offset)[0], i) for (i, offset) in enumerate(offsets))
+        (player_index, stairs_index) = (indices[player_id], indices[stairs_id])
+        upstairs_index = indices[upstairs_id] if upstairs_id else -1
+    else:
+        (player_index, stairs_index, upstairs_index) = struct.unpack('<iii', sections['REFS'])
+        next_id = None
+ 
+    (player, offset) = unpack_object(objects_data, offsets[player_index], record)
+    initialize_fov()
+    compute_fov()
+ 
+    position = record.size - 9  #where x and y are in a record, the fields before them are the ids
+    loaded = {player_index: player}
+    for (i, offset) in enumerate(offsets):
+        (x, y, char, r, g, b, flags) = struct.unpack_from('<HHBBBBB', objects_data, offset + position)
+        if (in_fov(x, y) or (flags & OBJECT_ALWAYS_VISIBLE and map[x][y].explored)
+                or i in (stairs_index, upstairs_index)):
+            if i not in loaded:
+                loaded[i] = unpack_object(objects_data, offset, record)[0]
+    objects = ObjectList(loaded[i] for i in sorted(loaded))
+    stairs = loaded[stairs_index]
+    upstairs = loaded[upstairs_index] if upstairs_index >= 0 else None
+    if next_id is not None:
+        object_ids.next_id = next_id
+ 
+    #of the inventory, only the equipped items
+    inventory_data = sections['INVT']
+    inventory_offsets = record_offsets(inventory_data, record)
+    loaded_items = dict((i, unpack_object(inventory_data, offset, record)[0]) for (i, offset) in enumerate(inventory_offsets)
+        if ord(inventory_data[offset + record.size - 1]) & OBJECT_EQUIPPED)
+    inventory = [loaded_items[i] for i in sorted(loaded_items)]
+ 
+    #the message log starts with the messages on the panel
+    entries = pickle.loads(sections['MSGS'])
+    for tail in message_tails:
+        entries.pop()  #comes again in the tail, maybe with a higher count
+        entries.extend(pickle.loads(tail))
+    entries = entries[-MSG_HISTORY:]
+    game_msgs = MessageLog()
+    game_msgs.entries.extend(unpack_messages(entries[-MSG_HEIGHT:]))
+    game_msgs.added = len(entries)
+    msg_version += 1
+ 
+    pending_load = {'objects': (objects_data, offsets, loaded, record),
+        'inventory': (inventory_data, inventory_offsets, loaded_items, record), 'messages': entries[:-MSG_HEIGHT]}
+ 
+    #a journal can only go on with a save file of this version. the records of the game as it was saved, which
+    #the next entry is made against, are left in the sections until then
+    if journal is not None and version == SAVE_VERSION and 'STRM' not in sections:
+        remember_saved(None, save_size, os.path.getsize(SAVE_JOURNAL))
+        journal_state['saved'] = (sections, offsets, inventory_offsets)
+    else:
+        journal_state = None  #the next save starts over with a new save file and journal
+ 
+def finish_loading(*parts):
+    #load what load_game left for later, or only the parts asked for: 'objects', the ones away from the player,
+    #'inventory', the items that aren't equipped, and 'messages', the older ones. returns True if there was
+    #anything left
+    global objects, inventory, msg_version, pending_load, tile_index_turn, hover_state
+    if pending_load is None:
+        return False
+ 
+    found = False
+    for part in parts or ['objects', 'inventory', 'messages']:
+        if part not in pending_load:
+            continue
+        found = True
+        pending = pending_load.pop(part)
+        if part == 'objects':
+            objects = ObjectList(merge_loaded(objects, *pending))
+            tile_index_turn = None  #the objects under the mouse have to be looked up again
+            hover_state = None
+        elif part == 'inventory':
+            inventory = merge_loaded(inventory, *pending)
+        else:
+            older = unpack_messages(pending)
+            game_msgs.entries = collections.deque(older + list(game_msgs.entries), maxlen=MSG_HISTORY)
+            msg_version += 1
+    if not pending_load:
+        pending_load = None
+    return found
+ 
+def merge_loaded(current, data, offsets, loaded, record):
+    #the objects of a table of records in its order, unpacking the ones load_game didn't. of the ones it did
+    #("loaded", by their place in the table), only those still in "current" are kept, and the objects added to
+    #"current" since go at the end
+    ids = set(obj.id for obj in current)
+    loaded_ids = set(obj.id for obj in loaded.values())
+    return ([loaded[i] if i in loaded else unpack_object(data, offset, record)[0]
+            for (i, offset) in enumerate(offsets) if i not in loaded or loaded[i].id in ids] +
+        [obj for obj in current if obj.id not in loaded_ids])
+ 
+def legacy_template(obj):
+    #the template of an object saved before there were any. items that are used go by what using them does,
+    #as the potions share a name, and the rest by name, corpses by the name of the monster they were
+    if obj.item and obj.item.use_function is not None:
+        uses = {cast_heal: 'heal', cast_poison: 'poison', cast_lightning: 'lightning', cast_fireball: 'fireball',
+            cast_confuse: 'confuse'}
+        return uses[obj.item.use_function]
+    name = obj.name
+    if name.startswith('remains of '):
+        name = name[len('remains of '):]
+    if name not in TEMPLATE_IDS:
+        raise ValueError('no template for ' + repr(obj.name))
+    return name
+ 
+def load_legacy_game():
+    #open a game saved in a shelve, before there was a save format of its own
+    global map, objects, player, stairs, inventory, game_msgs, msg_version, game_state, dungeon_level, upstairs
+    global MAP_WIDTH, MAP_HEIGHT, journal_state
  
     file = shelve.open('savegame', 'r')
-    map = file['map']
-    objects = file['objects']
+    map = chunked_map(file['map'])
+    (MAP_WIDTH, MAP_HEIGHT) = (len(map), len(map[0]))
+    objects = file['objects']  #a plain list until the objects have ids, see below
     player = objects[file['player_index']]  #get index of player in objects list and access it
     inventory = file['inventory']
     game_msgs = file['game_msgs']
+    if isinstance(game_msgs, list):
+        #saved before the message log kept whole messages, the old lines become the history
+        log = MessageLog()
+        for (line, color) in game_msgs:
+            log.add(line, color)
+        game_msgs = log
+    msg_version += 1
     game_state = file['game_state']
     stairs = objects[file['stairs_index']]
     upstairs = objects[file['upstairs_index']]
     dungeon_level = file['dungeon_level']
     file.close()
  
+    #objects from before templates existed
+    for obj in objects + inventory:
+        if not hasattr(obj, 'template'):
+            obj.template = legacy_template(obj)
+        if not hasattr(obj, 'id'):
+            obj.id = object_ids.next()
+    objects = ObjectList(objects)
+ 
     initialize_fov()
+    journal_state = None
  
 def new_game():
-    global player, inventory, game_msgs, game_state, dungeon_level
+    global player, inventory, game_msgs, game_state, dungeon_level, journal_state, pending_load
  
     #create object representing the player
-    """This houses the starting player stats"""
-    fighter_component = Fighter(hp=100, defense=0, power=0, lore=0, xp = 0, death_function=player_death)
-    player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component)
-
-    player.level = 1
+    player = make_object('player', 0, 0)
  
     #generate map (at this point it's not drawn to the screen)
     dungeon_level = 10
@@ -1524,142 +3569,231 @@ def new_game():
     game_state = 'playing'
     inventory = []
  
-    #create the list of game messages and their colors, starts empty
-    game_msgs = []
+    #create the log of game messages and their colors, starts empty
+    game_msgs = MessageLog()
+    journal_state = None  #nothing of this game is saved yet
+    pending_load = None
+    clear_level_store()
  
     #a warm welcoming message!
     message('You have awakened in a room, with no memory of how you got there. There are stairs leading down.', libtcod.red)
 
     #initial equipment: a dagger
-    equipment_component = Equipment(slot='right hand', power_bonus=1)
-    obj = Object(0, 0, '-', 'dagger', libtcod.sky, equipment=equipment_component)
+    obj = make_object('dagger', 0, 0)
     inventory.append(obj)
-    equipment_component.equip()
+    obj.equipment.equip()
     obj.always_visible = True
 
+#a stored level is a LEVEL_HEADER, then its chunks (see ChunkedMap) in the order of map.chunks, each the
+#TILE_FLAGS of its tiles in the order the chunk has them, then the level's objects except for the player. the
+#chunks have a fixed place in the file, so they're sliced straight out of a memory map of it: the solid ones are
+#left as SOLID_CHUNK, and the others made from their slice in one go. that's also why it isn't compressed like
+#the save file.
+LEVEL_MAGIC = 'CCLV'
+LEVEL_VERSION = 4
+LEVEL_HEADER = struct.Struct('<4sHHHHIIIHH')  #magic, LEVEL_VERSION, width, height, MAX_ROOMS, where the player goes
+                                              #among the objects, the ids of the stairs and upstairs, player x and y
+KEPT_LEVELS = 1  #the levels up to this one are stored when the player leaves them, and come back as they were left
+ 
+def level_files():
+    #the files of all the stored levels, and of the chunks endless caves dropped
+    return glob.glob(LEVEL_FILE.replace('%d', '*')) + glob.glob(CHUNK_FILE.replace('%d', '*'))
+ 
+def store_level(level):
+    #write the current level to its file, to be brought back by load_level
+    write_level(LEVEL_FILE % level)
+ 
+def write_level(path):
+    #write the current level to a file in the format of the level store
+    others = [obj for obj in objects if obj is not player]
+    file = open(path, 'wb')
+    file.write(LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, map.width, map.height, MAX_ROOMS,
+        objects.index(player), stairs.id, upstairs.id if upstairs else 0, player.x, player.y))
+    for column in map.chunks:
+        for chunk in column:
+            if chunk is SOLID_CHUNK:
+                file.write(SOLID_FLAGS)
+            else:
+                file.write(tile_flags(chunk))
+    file.write(pack_objects(others))
+    file.close()
+ 
+def load_level(level):
+    #make the stored level the current one, with the player where they left it. returns False if it wasn't stored
+    global map, objects, stairs, upstairs, MAX_ROOMS, MAP_WIDTH, MAP_HEIGHT
+ 
+    path = LEVEL_FILE % level
+    if not os.path.exists(path):
+        return False
+ 
+    file = open(path, 'rb')
+    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        (magic, version) = struct.unpack_from('<4sH', data)
+        if (magic, version) != (LEVEL_MAGIC, LEVEL_VERSION):
+            return False
+        (magic, version, width, height, MAX_ROOMS, player_index, stairs_id, upstairs_id,
+            player_x, player_y) = LEVEL_HEADER.unpack_from(data)
+        (MAP_WIDTH, MAP_HEIGHT) = (width, height)
+ 
+        map = ChunkedMap(width, height)
+        offset = LEVEL_HEADER.size
+        for column in map.chunks:
+            for cy in range(len(column)):
+                flags = data[offset:offset + CHUNK_SIZE * CHUNK_SIZE]
+                if flags != SOLID_FLAGS:
+                    column[cy] = map_tiles(bytearray(flags))
+                offset += CHUNK_SIZE * CHUNK_SIZE
+ 
+        objects = ObjectList(unpack_objects(data[offset:]))
+    finally:
+        data.close()
+        file.close()
+ 
+    objects.insert(player_index, player)
+    (player.x, player.y) = (player_x, player_y)
+    stairs = objects.by_id[stairs_id]
+    upstairs = objects.by_id[upstairs_id] if upstairs_id else None
+    return True
+ 
+def clear_level_store():
+    #forget the stored levels, they belong to another game
+    for path in level_files():
+        os.remove(path)
+ 
+def change_level(step, make_level):
+    #take the player "step" levels down, or up if it's negative. the player object goes along as it is, with
+    #all its stats. the new level comes back from the level store if it was kept, otherwise make_level makes it
+    global dungeon_level
+ 
+    if dungeon_level <= KEPT_LEVELS:
+        store_level(dungeon_level)
+    dungeon_level += step
+ 
+    if not load_level(dungeon_level):
+        make_level()
+    initialize_fov()
+ 
 def next_level():
-    global dungeon_level, MAX_ROOMS, MAP_HEIGHT, MAP_WIDTH
-
-    #save the state of the first level
-    if dungeon_level < 2:
-        file = shelve.open('persistence1', 'n')
-        file['map'] = map
-        file['objects'] = objects
-        file['player_index'] = objects.index(player)
-        file['stairs_index'] = objects.index(stairs)
-        file.close
-
     #advance to the next level
-    dungeon_level += 1
     message('You descend deeper into the heart of the dungeon...', libtcod.red)
+    change_level(1, make_level_below)
+ 
+def make_level_below():
+    global MAX_ROOMS, MAP_HEIGHT, MAP_WIDTH
+ 
     if dungeon_level < 10:
         MAX_ROOMS *= 1.5
         MAX_ROOMS = int(round(MAX_ROOMS))
         MAP_WIDTH += 10
         MAP_HEIGHT += 10
         make_map()  #create a new level
-        initialize_fov()
+    elif endless_caves:
+        make_endless_cave_map()  #a cave that goes on as far as the player walks
     else:
         make_cave_map() #create a new cave level
-        initialize_fov()
-
+ 
 def previous_level():
-    global dungeon_level, map, objects, player, stairs, MAX_ROOMS, MAP_HEIGHT, MAP_WIDTH
-
-    #advance to the next level
-    dungeon_level -= 1
-    
+    #go back up a level
+    change_level(-1, make_level_above)
+ 
+    if dungeon_level > 1:
+        message('You climb up to a higher dungeon level...', libtcod.red)
+    else:
+        message('You enjoy a rare moment of peace in an issolated place...', libtcod.light_violet)
+ 
+def make_level_above():
+    global MAX_ROOMS, MAP_HEIGHT, MAP_WIDTH
+ 
     if dungeon_level > 1 and dungeon_level < 10:
         MAX_ROOMS /= 1.5
         MAX_ROOMS = int(round(MAX_ROOMS))
         MAP_WIDTH -= 10
         MAP_HEIGHT -= 10
         make_map_going_up()  #generate a new higher level!
-        initialize_fov()
-        message('You climb up to a higher dungeon level...', libtcod.red)
+    elif dungeon_level > 9 and endless_caves:
+        make_endless_cave_map()
     elif dungeon_level > 9:
         make_cave_map_going_up()  #generate a new higher level!
-        initialize_fov()
-        message('You climb up to a higher dungeon level...', libtcod.red)
     else:
-        file = shelve.open('stats', 'n')
-        file['hp'] = player.fighter.hp
-        file['xp'] = player.fighter.xp
-        file['lore'] = player.fighter.lore
-        file['power'] = player.fighter.power
-        file['defense'] = player.fighter.defense
-        file['level'] = player.level
-        file['max_hp'] = player.fighter.max_hp
-        file.close
-
-        make_initial_map()
-         
-        file = shelve.open('persistence1', 'r')
-        map = file['map']
-        objects = file['objects']
-        player = objects[file['player_index']]
-        stairs = objects[file['stairs_index']]
-        file.close
-
-        file = shelve.open('stats', 'r')
-        player.fighter.hp = file['hp']
-        player.fighter.xp = file['xp']
-        player.fighter.lore = file['lore']
-        player.fighter.power = file['power']
-        player.fighter.defense = file['defense']
-        player.level = file['level']
-        player.fighter.max_hp = file['max_hp']
-        file.close
-
-        initialize_fov()  
-        message('You enjoy a rare moment of peace in an issolated place...', libtcod.light_violet)
-
-
-def initialize_fov():
-    global fov_recompute, fov_map
-    fov_recompute = True
+        make_initial_map()  #the first level wasn't kept, so it's made again
  
-    #create the FOV map, according to the generated map
-    fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            libtcod.map_set_properties(fov_map, x, y, not map[x][y].blocked, not map[x][y].block_sight)
  
-    libtcod.console_clear(con)  #unexplored areas start black (which is the default background color)
+def initialize_fov():
+    #create the FOV map, according to the generated map. it covers the view, which is put around the player
+    global view_width, view_height
+    (view_width, view_height) = (0, 0)  #the old view went with the old level
+    stream_around_player()
+    move_camera(player.x, player.y)
+    place_view()
  
 def play_game():
-    global camera_x, camera_y, key, mouse
+    global camera_x, camera_y, key, mouse, game_turn, tile_index_turn, hover_state
  
     player_action = None
     mouse = libtcod.Mouse()
     key = libtcod.Key()
  
+    #forget anything cached from a previous game
+    game_turn = 0
+    tile_index_turn = None
+    hover_state = None
+ 
     (camera_x, camera_y) = (0, 0)
+    last_xp = None
+    turns_since_save = 0
+    saved_level = dungeon_level
  
     while not libtcod.console_is_window_closed():
         #render the screen
-        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
         render_all()
  
-        libtcod.console_flush()
-
-        check_level_up()
+        frame_times.start()
+        flush_console()
+        frame_times.lap('flush')
  
-        #erase all objects at their old locations, before they move
-        for object in objects:
-            object.clear()
+        #a level up can only happen when the experience has changed since the last check
+        if player.fighter.xp != last_xp:
+            if check_level_up():
+                continue  #show the new stats, and check again in case there's another level to gain
+            last_xp = player.fighter.xp
+ 
+        #nothing changes in a turn-based game until the player does something, so
+        #sleep until a key is pressed or the mouse moves instead of polling every frame
+        frame_times.start()
+        wait_for_event(key, mouse)
+        frame_times.lap('poll')  #mostly the player thinking
+ 
+        #a loaded game is shown with only the objects in view, a command may need any of them
+        if key.vk != libtcod.KEY_NONE:
+            finish_loading('objects')
  
         #handle keys and exit game if needed
         player_action = handle_keys()
+        frame_times.lap('keys')
         if player_action == 'exit':
             save_game()
             break
  
+        #any command may have changed the world, so a key press starts a new turn for the caches keyed on it
+        if key.vk != libtcod.KEY_NONE:
+            game_turn += 1
+ 
         #let monsters take their turn
         if game_state == 'playing' and player_action != 'didnt-take-turn':
+            frame_times.start()
             for object in objects:
                 if object.ai:
                     object.ai.take_turn()
+            frame_times.lap('monsters')
+            turns_since_save += 1
+            input_log.turn()
+ 
+        #save every so often and on reaching a new level, so a crash doesn't lose much
+        if game_state == 'playing' and (turns_since_save >= AUTOSAVE_TURNS or dungeon_level != saved_level):
+            autosave()
+            turns_since_save = 0
+            saved_level = dungeon_level
  
 def main_menu():
     #This is the background image. It needs to be double the screen w/h dimensions in pixels (80x50 becomes 160x100)
@@ -1668,6 +3802,7 @@ def main_menu():
     while not libtcod.console_is_window_closed():
         #show the background image, at twice the regular console resolution
         libtcod.image_blit_2x(img, 0, 0, 0)
+        root_changed()
  
         #show the game's title, and some credits!
         libtcod.console_set_default_foreground(0, libtcod.light_yellow)
@@ -1676,6 +3811,7 @@ def main_menu():
  
         #show options and wait for the player's choice
         choice = menu('', ['Begin the search', 'Resume your search', 'Quit'], 25)
+        root_changed()  #the game, or the menu again, covers the whole screen
         if choice == 0:  #new game
             new_game()
             play_game()
@@ -1689,10 +3825,543 @@ def main_menu():
         elif choice == 2:  #quit
             break
  
-libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'Chale & the Voidmen', False)
-libtcod.sys_set_fps(LIMIT_FPS)
-con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+def benchmark_saves(levels=5):
+    #save and load a game a few levels deep with each kind of compression, and report the file sizes and times
+    global SAVE_COMPRESSION, journal_state
+    use_files_named(BENCHMARK_PREFIX)  #leave the real save and levels alone
+ 
+    new_game()
+    for i in range(levels):
+        next_level()
+ 
+    for codec in CODECS:
+        if codec == 'lzma' and lzma is None:
+            continue
+        SAVE_COMPRESSION = codec
+        journal_state = None  #a whole save file every time
+ 
+        start = time.time()
+        save_game()
+        save_time = time.time() - start
+        size = os.path.getsize(SAVE_FILE)
+ 
+        start = time.time()
+        load_game()
+        first_frame_time = time.time() - start
+        finish_loading()
+        load_time = time.time() - start
+        sys.stdout.write('%-5s %9d bytes  save %7.1f ms  load %7.1f ms (first frame after %.1f ms)\n' %
+            (codec, size, save_time * 1000, load_time * 1000, first_frame_time * 1000))
+ 
+    os.remove(SAVE_FILE)
+    os.remove(SAVE_JOURNAL)
+    clear_level_store()
+ 
+def use_files_named(prefix):
+    #keep the saved game and the stored levels in files of their own, named with prefix in front of the usual names
+    global SAVE_FILE, SAVE_JOURNAL, LEVEL_FILE, CHUNK_FILE
+    SAVE_FILE = prefix + SAVE_FILE
+    SAVE_JOURNAL = prefix + SAVE_JOURNAL
+    LEVEL_FILE = prefix + LEVEL_FILE
+    CHUNK_FILE = prefix + CHUNK_FILE
+ 
+ 
+BOT_LEVEL_TURNS = 400  #a bot that has been on a level this long heads for the stairs, explored or not
+BOT_HEAL_BELOW = 0.4  #it drinks a healing potion when its hp falls under this much of the maximum
+BOT_STATS = [0, 1, 2]  #the stats it raises on a level up, in turn (the choices of check_level_up)
+BOT_STEPS = [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+ 
+class Bot:
+    #plays the game by itself for run_bot. it drinks a healing potion when it's hurt, fights the monsters it sees,
+    #picks up the items it sees and explores the rest. once there's nothing left to explore, or it's been on the
+    #level too long, it takes the stairs down.
+    def __init__(self):
+        self.path = []  #the rest of the steps to where it's going, as (dx, dy)
+        self.level = None
+        self.level_turns = 0
+        self.picked_up = collections.Counter()  #the kinds of items it picked up and used, for run_batch
+        self.used = collections.Counter()
+ 
+    def choose(self):
+        #decide what to do this turn. returns the name of the action and a function that does it
+        if dungeon_level != self.level:
+            (self.level, self.level_turns, self.path) = (dungeon_level, 0, [])
+        self.level_turns += 1
+ 
+        if player.fighter.hp < player.fighter.max_hp * BOT_HEAL_BELOW:
+            for obj in inventory:
+                if obj.template == 'heal':
+                    self.used[obj.template] += 1
+                    return ('use', obj.item.use)
+ 
+        monster = self.closest(lambda object: object.fighter and object.ai)
+        if monster is not None:
+            (dx, dy) = (monster.x - player.x, monster.y - player.y)
+            if abs(dx) <= 1 and abs(dy) <= 1:
+                return ('attack', lambda: player_move_or_attack(dx, dy))
+            path = self.find_path(lambda x, y: (x, y) == (monster.x, monster.y))
+            if path:
+                return self.step(path, keep=False)  #it moves, so the way to it is found again next turn
+ 
+        if len(inventory) < 26:
+            for object in objects:
+                if object.item and (object.x, object.y) == (player.x, player.y):
+                    self.picked_up[object.template] += 1
+                    return ('pick up', object.item.pick_up)
+            item = self.closest(lambda object: object.item)
+            if item is not None:
+                path = self.find_path(lambda x, y: (x, y) == (item.x, item.y))
+                if path:
+                    return self.step(path, keep=False)
+ 
+        if self.path:
+            return self.step(self.path)
+        if self.level_turns <= BOT_LEVEL_TURNS:
+            path = self.find_path(lambda x, y: not map[x][y].explored)
+            if path:
+                return self.step(path)
+        if (player.x, player.y) == (stairs.x, stairs.y):
+            return ('descend', next_level)
+        path = self.find_path(lambda x, y: (x, y) == (stairs.x, stairs.y))
+        if path:
+            return self.step(path)
+        return ('descend', next_level)  #there's no way to the stairs, so it cheats rather than get stuck
+ 
+    def step(self, path, keep=True):
+        #take the first of the steps, and follow the rest in the turns after unless keep is False
+        (dx, dy) = path[0]
+        self.path = path[1:] if keep else []
+        return ('move', lambda: player_move_or_attack(dx, dy))
+ 
+    def closest(self, kind):
+        #the nearest object the player can see that kind(object) accepts
+        found = None
+        for object in objects:
+            if object is not player and kind(object) and in_fov(object.x, object.y):
+                if found is None or player.distance_to(object) < player.distance_to(found):
+                    found = object
+        return found
+ 
+    def find_path(self, goal):
+        #the steps to the nearest tile that goal(x, y) accepts, going around walls, or None if there's no such tile
+        start = (player.x, player.y)
+        came_from = {start: None}
+        frontier = collections.deque([start])
+        while frontier:
+            position = frontier.popleft()
+            (x, y) = position
+            if position != start and goal(x, y):
+                path = []
+                while came_from[position] is not None:
+                    (from_x, from_y) = came_from[position]
+                    path.append((position[0] - from_x, position[1] - from_y))
+                    position = came_from[position]
+                path.reverse()
+                return path
+            for (dx, dy) in BOT_STEPS:
+                next = (x + dx, y + dy)
+                if (0 <= next[0] < map.width and 0 <= next[1] < map.height and next not in came_from and
+                        not map[next[0]][next[1]].blocked):
+                    came_from[next] = position
+                    frontier.append(next)
+        return None
+ 
+def bot_game(turns, seed):
+    #let a Bot play a new game from the seed for a number of turns, or until it dies, with nothing shown.
+    #returns what happened as a dict: how long it lasted and got, where the time went, the damage the player
+    #took and the turns it spent on each level, and the items the bot picked up and used
+    global headless, game_turn, rng
+    headless = True
+    if rng != 0:
+        libtcod.random_delete(rng)
+    rng = libtcod.random_new_from_seed(seed)
+    times = collections.OrderedDict((name, 0.0) for name in ['new game', 'fov', 'bot', 'player', 'levels', 'monsters'])
+    damage = collections.Counter()
+    level_turns = collections.Counter()
+ 
+    start = time.time()
+    new_game()
+    times['new game'] = time.time() - start
+ 
+    bot = Bot()
+    played = 0
+    while played < turns and game_state == 'playing':
+        before = time.time()
+        render_all()  #only computes the FOV and explores what's in it
+        after = time.time()
+        times['fov'] += after - before
+ 
+        (before, (action, act)) = (after, bot.choose())
+        after = time.time()
+        times['bot'] += after - before
+ 
+        before = after
+        act()
+        after = time.time()
+        times['levels' if action == 'descend' else 'player'] += after - before
+        game_turn += 1
+ 
+        before = after
+        hp = player.fighter.hp
+        if game_state == 'playing':
+            for object in objects:
+                if object.ai:
+                    object.ai.take_turn()
+        damage[dungeon_level] += max(hp - player.fighter.hp, 0)
+        level_turns[dungeon_level] += 1
+        times['monsters'] += time.time() - before
+ 
+        while check_level_up(BOT_STATS[player.level % len(BOT_STATS)]):
+            pass
+        played += 1
+ 
+    elapsed = time.time() - start
+    clear_level_store()
+    return {'seed': seed, 'turns': played, 'time': elapsed, 'times': times, 'died': game_state == 'dead',
+        'depth': dungeon_level, 'level': player.level, 'damage': damage, 'level turns': level_turns,
+        'picked up': bot.picked_up, 'used': bot.used}
+ 
+def run_bot(turns, seed):
+    #play one bot_game, and report how fast the game ran, where the time went and the most memory it took
+    use_files_named(BOT_PREFIX)  #leave the real save and levels alone
+    game = bot_game(turns, seed)
+    (played, elapsed) = (game['turns'], game['time'])
+ 
+    sys.stdout.write('seed %d: %d turns in %.2f s, %.0f turns/s. the bot %s on dungeon level %d at level %d\n' %
+        (seed, played, elapsed, played / elapsed, 'died' if game['died'] else 'is still alive',
+        game['depth'], game['level']))
+    for (name, spent) in game['times'].items():
+        sys.stdout.write('%-9s %9.1f ms %5.1f%% %8.1f us/turn\n' %
+            (name, spent * 1000, spent * 100 / elapsed, spent * 1000000 / max(played, 1)))
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak *= 1024  #kilobytes everywhere but on macOS
+        sys.stdout.write('peak memory %.1f MB\n' % (peak / 1048576.0))
+ 
+ 
+def run_in_processes(function, jobs, processes, start_process=None):
+    #call function on every job, in a pool of processes that each call start_process first (if there is one).
+    #with only one process it's all done in this one. returns the results in the order they were done
+    if processes == 1:
+        if start_process is not None:
+            start_process()
+        return [function(job) for job in jobs]
+    pool = multiprocessing.Pool(processes, start_process)
+    results = list(pool.imap_unordered(function, jobs, chunksize=max(len(jobs) / (processes * 8), 1)))
+    pool.close()
+    pool.join()
+    return results
+ 
+BATCH_TURNS = 5000  #how long a game of run_batch may last, unless it's given with --bot
+ 
+def start_batch_process():
+    #each process of run_batch keeps its stored levels apart from the others'
+    use_files_named(BOT_PREFIX + str(os.getpid()) + '-')
+ 
+def batch_game(job):
+    #one game of run_batch, in one of its processes
+    (turns, seed) = job
+    return bot_game(turns, seed)
+ 
+def run_batch(games, turns, first_seed, processes):
+    #play a number of bot games, from one seed after another, spread over a pool of processes (every game is on
+    #its own, so that goes about as many times faster as there are processes). then report on all of them together.
+    jobs = [(turns, seed) for seed in range(first_seed, first_seed + games)]
+    start = time.time()
+    results = run_in_processes(batch_game, jobs, processes, start_batch_process)
+    elapsed = time.time() - start
+ 
+    lengths = sorted(game['turns'] for game in results)
+    played = sum(lengths)
+    sys.stdout.write('%d games (seeds %d to %d) in %.2f s with %d processes: %.1f games/s, %.0f turns/s\n' %
+        (games, first_seed, first_seed + games - 1, elapsed, processes, games / elapsed, played / elapsed))
+    sys.stdout.write('%.1f%% died. they lasted %.1f turns on average, %d at the median, %d at the most\n' %
+        (sum(game['died'] for game in results) * 100.0 / games, float(played) / games,
+        lengths[games / 2], lengths[-1]))
+    sys.stdout.write('character level reached: %.2f on average\n' % (sum(game['level'] for game in results) / float(games)))
+ 
+    sys.stdout.write('\ndepth reached:\n')
+    depths = collections.Counter(game['depth'] for game in results)
+    for depth in sorted(depths):
+        sys.stdout.write('  level %2d %7d games %5.1f%%\n' % (depth, depths[depth], depths[depth] * 100.0 / games))
+ 
+    sys.stdout.write('\ndamage taken on each level, by the games that got there:\n')
+    (damage, level_turns, reached) = (collections.Counter(), collections.Counter(), collections.Counter())
+    for game in results:
+        damage.update(game['damage'])
+        level_turns.update(game['level turns'])
+        reached.update(game['level turns'].keys())
+    for depth in sorted(reached):
+        sys.stdout.write('  level %2d %8.1f hp a game %6.2f hp a turn\n' %
+            (depth, float(damage[depth]) / reached[depth], float(damage[depth]) / level_turns[depth]))
+ 
+    sys.stdout.write('\nitems, per game:\n')
+    (picked_up, used) = (collections.Counter(), collections.Counter())
+    for game in results:
+        picked_up.update(game['picked up'])
+        used.update(game['used'])
+    for template in sorted(set(picked_up) | set(used)):
+        sys.stdout.write('  %-22s picked up %5.2f  used %5.2f\n' %
+            (template, float(picked_up[template]) / games, float(used[template]) / games))
+ 
+ 
+MAP_GENERATORS = {'make_map': make_map, 'make_map_going_up': make_map_going_up, 'make_cave_map': make_cave_map,
+    'make_initial_map': make_initial_map}  #what --mapgen can run
+MAPGEN_MIN_SIZES = {'make_map': ROOM_MAX_SIZE + 1, 'make_map_going_up': ROOM_MAX_SIZE + 1,
+    'make_cave_map': CAVE_MAX_SIZE + 1, 'make_initial_map': 46}  #the smallest level each can carve, see level_size.
+                                                                 #the room of make_initial_map is in a fixed place
+ 
+def reachable_tiles(x, y):
+    #the positions of all the tiles that can be walked to from x, y
+    reached = set([(x, y)])
+    frontier = [(x, y)]
+    while frontier:
+        (x, y) = frontier.pop()
+        for (dx, dy) in BOT_STEPS:
+            next = (x + dx, y + dy)
+            if (0 <= next[0] < MAP_WIDTH and 0 <= next[1] < MAP_HEIGHT and next not in reached and
+                    not map[next[0]][next[1]].blocked):
+                reached.add(next)
+                frontier.append(next)
+    return reached
+ 
+def timed(function, times, stage):
+    #function, but adding the time of every call to times[stage]
+    def timed_function(*args):
+        before = time.time()
+        try:
+            return function(*args)
+        finally:
+            times[stage] += time.time() - before
+    return timed_function
+ 
+def level_size(depth):
+    #the MAP_WIDTH, MAP_HEIGHT and MAX_ROOMS the game first makes a level at this depth with. new_game starts on
+    #level 10 with FIRST_LEVEL, and the caves below keep that size. make_level_above shrinks it for every level
+    #up from there to level 2, and level 1 is made at level 2's size
+    (width, height, rooms) = FIRST_LEVEL
+    for level in range(9, max(depth, 2) - 1, -1):
+        rooms = int(round(rooms / 1.5))
+        (width, height) = (width - 10, height - 10)
+    return (width, height, rooms)
+ 
+def generate_level(job):
+    #make one level for run_mapgen and write it to a file. returns how long each stage took and what the level is like
+    global rng, dungeon_level, player, stairs, upstairs, place_objects, MAP_WIDTH, MAP_HEIGHT, MAX_ROOMS
+    (generator, depth, seed, path) = job
+    if rng != 0:
+        libtcod.random_delete(rng)
+    rng = libtcod.random_new_from_seed(seed)
+    dungeon_level = depth
+    (MAP_WIDTH, MAP_HEIGHT, MAX_ROOMS) = level_size(depth)
+    player = make_object('player', 0, 0)
+    (stairs, upstairs) = (None, None)  #not every generator makes both at every depth
+    times = collections.OrderedDict((stage, 0.0) for stage in ['carve', 'place objects', 'metrics', 'write'])
+ 
+    #placing the objects happens inside the generator, so it's timed by putting a timed place_objects in its place
+    untimed = place_objects
+    place_objects = timed(untimed, times, 'place objects')
+    before = time.time()
+    try:
+        rooms = MAP_GENERATORS[generator]()
+    finally:
+        place_objects = untimed
+    times['carve'] = time.time() - before - times['place objects']
+ 
+    before = time.time()
+    reached = reachable_tiles(player.x, player.y)
+    level = {'seed': seed, 'times': times, 'rooms': rooms,
+        'tries': MAX_CAVES if generator == 'make_cave_map' else MAX_ROOMS if generator != 'make_initial_map' else 1,
+        'open': sum(not tile.blocked for column in map for tile in column) / float(MAP_WIDTH * MAP_HEIGHT),
+        'chunks': map.made_chunks(),
+        'stairs reachable': stairs and (stairs.x, stairs.y) in reached,  #None if there are none
+        'upstairs reachable': upstairs and (upstairs.x, upstairs.y) in reached}
+    times['metrics'] = time.time() - before
+ 
+    before = time.time()
+    write_level(path % seed)
+    times['write'] = time.time() - before
+    return level
+ 
+def run_mapgen(generator, depth, levels, first_seed, processes, out):
+    #make a number of levels with one of the MAP_GENERATORS, from one seed after another and spread over a pool
+    #of processes, and write them where load_level can read them. then report how fast that went, stage by
+    #stage, and how open the levels are, how many rooms they got and whether their stairs can be reached
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    path = os.path.join(out, '%s-%d-%%d.lvl' % (generator, depth))
+    jobs = [(generator, depth, seed, path) for seed in range(first_seed, first_seed + levels)]
+    start = time.time()
+    results = run_in_processes(generate_level, jobs, processes)
+    elapsed = time.time() - start
+ 
+    sys.stdout.write('%d levels from %s at depth %d (seeds %d to %d) in %.2f s with %d processes: %.1f levels/s\n' %
+        (levels, generator, depth, first_seed, first_seed + levels - 1, elapsed, processes, levels / elapsed))
+    sys.stdout.write('written to ' + path.replace('%d', '<seed>') + '\n')
+    for stage in results[0]['times']:
+        spent = sum(level['times'][stage] for level in results)
+        sys.stdout.write('  %-14s %8.2f ms a level\n' % (stage, spent * 1000 / levels))
+ 
+    opens = [level['open'] for level in results]
+    sys.stdout.write('open tiles: %.1f%% on average, %.1f%% to %.1f%%\n' %
+        (sum(opens) * 100 / levels, min(opens) * 100, max(opens) * 100))
+    sys.stdout.write('rooms: %.2f of %d tries on average, %d at the fewest\n' %
+        (sum(level['rooms'] for level in results) / float(levels), results[0]['tries'],
+        min(level['rooms'] for level in results)))
+    sys.stdout.write('chunks made: %.1f%% on average\n' %
+        (sum(float(made) / total for (made, total) in (level['chunks'] for level in results)) * 100 / levels))
+    for stairs_kind in ['stairs', 'upstairs']:
+        made = [level for level in results if level[stairs_kind + ' reachable'] is not None]
+        if len(made) < levels:
+            sys.stdout.write('%s missing from %d of %d levels\n' % (stairs_kind, levels - len(made), levels))
+        if not made:
+            continue
+        unreachable = sorted(level['seed'] for level in made if not level[stairs_kind + ' reachable'])
+        sys.stdout.write('%s reachable in %d of %d levels%s\n' % (stairs_kind, len(made) - len(unreachable), len(made),
+            ' (not from seeds ' + ', '.join(str(seed) for seed in unreachable[:10]) +
+            (', ...' if len(unreachable) > 10 else '') + ')' if unreachable else ''))
+ 
+ 
+#the state that isn't part of a game. the consoles are made by main, once the root console is there
+terminal = None  #the AnsiTerminal the game is shown in, with --terminal
+headless = False  #nothing is shown, during a replay or a bot run
+endless_caves = False  #with --endless-caves, see make_endless_cave_map
+input_log = None  #see InputLog
+rng = 0  #libtcod's own generator, until main makes one from the seed
+con = None  #made by place_view, once the size of the level is known
+fov_map = None
+(view_x, view_y, view_width, view_height) = (0, 0, 0, 0)  #the part of the level con and fov_map cover
+(camera_x, camera_y) = (0, 0)  #the part of the level the screen shows, see move_camera
+fov_position = None
+object_con = None
+object_buffer = libtcod.ConsoleBuffer(CAMERA_WIDTH, CAMERA_HEIGHT)
+drawn_glyphs = None
+panel = None
+console_pool = ConsolePool()
+panel_state = None
+frame_times = FrameTimes()
+show_timings = False  #F3 shows frame_times in the panel
+msg_version = 0
+game_turn = 0
+tile_index_turn = None
+hover_state = None
+journal_state = None
+save_writer = SaveWriter()
+pending_load = None
+ 
+def main():
+    global SAVE_COMPRESSION, terminal, headless, input_log, rng, object_con, panel, endless_caves
+ 
+    parser = argparse.ArgumentParser(description='Castles and Catacombs')
+    parser.add_argument('--terminal', action='store_true',
+        help='play inside this terminal using ANSI escape codes instead of opening a window (works over SSH)')
+    parser.add_argument('--compression', choices=CODECS, default=SAVE_COMPRESSION,
+        help='how to compress save files (default: %(default)s)')
+    parser.add_argument('--seed', type=int,
+        help='seed for the random number generator, to play the same dungeon again (default: a random one)')
+    parser.add_argument('--replay', metavar='FILE',
+        help='play back the input log of a session as fast as possible without showing anything, '
+            'and report how long it took (every session is logged to ' + INPUT_LOG + ')')
+    parser.add_argument('--benchmark-saves', action='store_true',
+        help='report the size of a save file and how long it takes to save and load with each compression, then quit')
+    parser.add_argument('--endless-caves', action='store_true',
+        help='make the cave levels endless: they are carved a chunk at a time as the player gets near, and the parts '
+            'left far behind are kept on disk')
+    parser.add_argument('--bot', type=int, metavar='TURNS',
+        help='let a simple bot play a new game for this many turns (or until it dies) without a window, and report '
+            'the turns per second, the time spent in each part of the game and the peak memory, then quit')
+    parser.add_argument('--batch', type=int, metavar='GAMES',
+        help='let the bot play this many games, seeded one after the other from --seed, and report how deep they got, '
+            'how long they lasted, the damage taken on each level and the items used. each game lasts up to '
+            '--bot turns (default: ' + str(BATCH_TURNS) + ')')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+        help='how many games --batch plays, or levels --mapgen makes, at once (default: one for each CPU, %(default)s)')
+    parser.add_argument('--mapgen', choices=sorted(MAP_GENERATORS), metavar='GENERATOR',
+        help='make --levels levels with this generator (one of ' + ', '.join(sorted(MAP_GENERATORS)) + '), '
+            'seeded one after the other from --seed, write them to --out and report how fast it went and how '
+            'good they are')
+    parser.add_argument('--depth', type=int, default=10,
+        help='the dungeon level --mapgen makes levels for. they are as big as a game first makes that level, and get '
+            'what is placed at that depth (default: %(default)s)')
+    parser.add_argument('--levels', type=int, default=100,
+        help='how many levels --mapgen makes (default: %(default)s)')
+    parser.add_argument('--out', default='levels',
+        help='the directory --mapgen writes its levels to, in the format of the level store (default: %(default)s)')
+    args = parser.parse_args()
+ 
+    if args.compression == 'lzma' and lzma is None:
+        parser.error('lzma compression needs the lzma module (backports.lzma on Python 2)')
+    SAVE_COMPRESSION = args.compression
+    endless_caves = args.endless_caves
+ 
+    seed = args.seed
+    if seed is None:
+        seed = struct.unpack('<I', os.urandom(4))[0]
+ 
+    #no window and no input for the bot or the map generators, so nothing is recorded either
+    if args.mapgen is not None:
+        (width, height, rooms) = level_size(args.depth)
+        if min(width, height) < MAPGEN_MIN_SIZES[args.mapgen]:
+            parser.error('%s can\'t carve a level as small as the ones at depth %d (%dx%d)' %
+                (args.mapgen, args.depth, width, height))
+        run_mapgen(args.mapgen, args.depth, args.levels, seed, max(args.processes, 1), args.out)
+        return
+    if args.batch is not None:
+        run_batch(args.batch, args.bot or BATCH_TURNS, seed, max(args.processes, 1))
+        return
+    if args.bot is not None:
+        run_bot(args.bot, seed)
+        return
+    if args.benchmark_saves:
+        #the saves it loads are recorded nowhere, so the log of the last real session is left as it was
+        headless = True
+        input_log = InputLog(os.devnull, seed)
+        rng = libtcod.random_new_from_seed(seed)
+        benchmark_saves()
+        return
+ 
+    if args.terminal:
+        if termios is None:
+            parser.error('--terminal needs a POSIX terminal')
+        #nothing is shown by SDL in terminal mode, the root console only lives in memory
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+ 
+    if args.replay:
+        input_log = InputLog(args.replay)
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        headless = True
+        use_files_named(REPLAY_PREFIX)
+    else:
+        input_log = InputLog(INPUT_LOG, seed)
+ 
+    #everything random in the game comes from this generator, so the same seed and input make the same game
+    rng = libtcod.random_new_from_seed(input_log.seed)
+    input_log.saved_files(level_files())  #a level stored by an earlier session may be come back to
+ 
+    libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+    libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'Chale & the Voidmen', False)
+    libtcod.sys_set_fps(LIMIT_FPS)
+    object_con = libtcod.console_new(CAMERA_WIDTH, CAMERA_HEIGHT)
+    panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+ 
+    if args.replay:
+        start = time.time()
+        try:
+            main_menu()
+        except ReplayEnded:
+            pass
+        sys.stdout.write('replayed %d events and %d turns in %.2f s\n' %
+            (input_log.events, input_log.turns, time.time() - start))
+    elif args.terminal:
+        terminal = AnsiTerminal(SCREEN_WIDTH, SCREEN_HEIGHT)
+        terminal.start()
+        try:
+            main_menu()
+        finally:
+            terminal.stop()
+    else:
+        main_menu()
  
-main_menu()
+if __name__ == '__main__':
+    main()